@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from itertools import islice
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+from agent_execute import execute_agent
+from agent_execute.embedding_index import EmbeddingIndex, IVFIndex, normalize
+
+'''
+ExecuteAgent候选检索的性能基准（在仓库根目录运行），用法：
+python -m agent_execute.benchmark retrieve [--actions 50000] [--dim 1536] [--steps 20]
+python -m agent_execute.benchmark ann [--actions 200000] [--dim 256] [--steps 200] [--noise 1.0]
+python -m agent_execute.benchmark startup [--actions 1000] [--dim 1536]
+'''
+
+
+def synthetic_graph(action_count, dim, seed=0):
+    # 每个场景有50条出边的合成图，向量为随机的list，与事件文件中读出的格式一致
+    rng = np.random.default_rng(seed)
+    actions = {f"action-{i}": {'action_name': f"action {i}", 'action_description': "", 'bounds': "",
+                               'action_type': "touch", 'embedding': rng.standard_normal(dim).tolist()}
+               for i in range(action_count)}
+    scenes = {f"scene-{i}": {'page_name': f"scene {i}", 'page_description': "",
+                             'embedding': rng.standard_normal(dim).tolist()}
+              for i in range(max(1, action_count // 50))}
+    return scenes, actions, rng
+
+
+def legacy_get_candidate(action_hash_list):
+    # 原来的实现：每一步重新收集向量列表，限定出边时对每条出边线性扫描Action_hash_dict
+    actions = execute_agent.Action_hash_dict
+    candidates, candidates_index_list = [], []
+    for node in action_hash_list:
+        for action_index, (key, value) in enumerate(actions.items()):
+            if key == node['hash_id']:
+                candidates.append(value['embedding'])
+                candidates_index_list.append(action_index)
+                break
+    if len(candidates) == 0:
+        candidates = [value['embedding'] for value in actions.values()]
+    return candidates, candidates_index_list
+
+
+def legacy_get_node_info(index, matched_embedding, candidates_index_list):
+    actions = execute_agent.Action_hash_dict
+    if len(candidates_index_list) == 0:
+        for key, value in actions.items():
+            if value['embedding'] == matched_embedding:
+                return key
+        return "No Match"
+    key, _ = next(islice(actions.items(), candidates_index_list[index], None))
+    return key
+
+
+def legacy_retrieve(target, action_hash_list, k):
+    candidates, candidates_index_list = legacy_get_candidate(action_hash_list)
+    similarity_scores = cosine_similarity(target, candidates)
+    top_same_indices = np.argsort(similarity_scores[0])[-min(k, len(candidates)):][::-1]
+    return [legacy_get_node_info(idx, candidates[idx], candidates_index_list) for idx in top_same_indices]
+
+
+def index_retrieve(agent, target, action_hash_list, k):
+    candidate_index, candidate_rows = agent.get_candidate("action", action_hash_list)
+    return [hash_id for hash_id, _ in candidate_index.search(target[0], k, candidate_rows)]
+
+
+def bench_retrieve(action_count, dim, steps, k=10):
+    scenes, actions, rng = synthetic_graph(action_count, dim)
+    execute_agent.Scene_hash_dict.update(scenes)
+    execute_agent.Action_hash_dict.update(actions)
+    agent = execute_agent.ExecuteAgent()
+    start = time.perf_counter()
+    agent.scene_index = EmbeddingIndex.from_dict(execute_agent.Scene_hash_dict)
+    agent.action_index = EmbeddingIndex.from_dict(execute_agent.Action_hash_dict)
+    print(f"actions: {action_count}, dim: {dim}, build index: {time.perf_counter() - start:.2f}s")
+    keys = list(actions.keys())
+    targets = [[rng.standard_normal(dim).tolist()] for _ in range(steps)]
+    # 一半的步骤在全部动作中检索，另一半限定为上一个场景的出边（排在字典末尾的动作，线性扫描的最坏情况）
+    hash_lists = [[] if i % 2 == 0 else [{'hash_id': key} for key in keys[-50:]] for i in range(steps)]
+    results = {}
+    for name, retrieve in [("legacy", legacy_retrieve), ("index", lambda *args: index_retrieve(agent, *args))]:
+        start = time.perf_counter()
+        results[name] = [retrieve(target, hash_list, k) for target, hash_list in zip(targets, hash_lists)]
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / steps * 1000:.1f}ms/step")
+    print(f"same top-{k}: {results['legacy'] == results['index']}")
+
+
+def clustered_embeddings(count, dim, rng, cluster_count=2000, noise=1.0):
+    # 真实的文本向量集中在若干语义簇附近，纯随机向量没有这种结构，近似检索的召回率会被低估
+    centers = rng.standard_normal((cluster_count, dim)).astype(np.float32)
+    labels = rng.integers(0, cluster_count, count)
+    return centers[labels] + noise * rng.standard_normal((count, dim)).astype(np.float32)
+
+
+def ann_recall(truth, found):
+    return float(np.mean([len(a & b) / len(a) for a, b in zip(truth, found)]))
+
+
+def bench_ann(action_count, dim, steps, k=10, noise=1.0, min_recall=0.9):
+    """
+    :param noise: 簇内噪声，越大簇结构越弱，近似检索需要探查的簇越多
+    :param min_recall: 自动选择探查簇数时实测recall@k的下限，低于下限时基准失败
+    """
+    rng = np.random.default_rng(0)
+    vectors = clustered_embeddings(action_count, dim, rng, noise=noise)
+    keys = [f"action-{i}" for i in range(action_count)]
+    exact = EmbeddingIndex(keys, vectors)
+    start = time.perf_counter()
+    ivf = IVFIndex(keys, vectors)
+    print(f"actions: {action_count}, dim: {dim}, noise: {noise}, lists: {len(ivf.centroids)}, "
+          f"train ivf: {time.perf_counter() - start:.2f}s")
+    # 查询为某个节点加噪声，模拟与图中节点描述相近的用例步骤
+    queries = vectors[rng.integers(0, action_count, steps)] + rng.standard_normal((steps, dim)).astype(np.float32)
+    start = time.perf_counter()
+    truth = [{key for key, _ in exact.search(query, k)} for query in queries]
+    exact_time = (time.perf_counter() - start) / steps
+    print(f"exact: {exact_time * 1000:.2f}ms/query")
+    for n_probe in [1, 4, 8, 16, 32, None]:
+        start = time.perf_counter()
+        found = [{key for key, _ in ivf.search(query, k, n_probe=n_probe)} for query in queries]
+        ivf_time = (time.perf_counter() - start) / steps
+        recall = ann_recall(truth, found)
+        name = f"n_probe={n_probe}" if n_probe else f"auto probe={ivf.probe} (estimated recall {ivf.recall:.3f})"
+        print(f"ivf {name}: {ivf_time * 1000:.2f}ms/query, speedup {exact_time / ivf_time:.1f}x, "
+              f"recall@{k}: {recall:.3f}")
+    # 默认配置（ann_probe = 0）下近似检索不能悄悄返回错误的候选
+    assert recall >= min_recall, f"auto probe recall@{k} {recall:.3f} < {min_recall}"
+    # 持久化后加载，并增量同步1%新增的节点
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "action_ivf.npz")
+        start = time.perf_counter()
+        ivf.save(path)
+        save_time = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = IVFIndex.load(path)
+        load_time = time.perf_counter() - start
+        extra = clustered_embeddings(action_count // 100, dim, rng)
+        hash_dict = {key: {'embedding': vector} for key, vector in zip(keys, vectors)}
+        hash_dict.update({f"new-action-{i}": {'embedding': vector} for i, vector in enumerate(extra)})
+        start = time.perf_counter()
+        added, updated, removed = loaded.sync(hash_dict)
+        print(f"save: {save_time:.2f}s, load: {load_time:.2f}s, sync: {time.perf_counter() - start:.2f}s "
+              f"(added {added}, updated {updated}, removed {removed})")
+
+
+def write_synthetic_events(path, event_count, dim, rng):
+    # 与标注、向量化之后的事件文件结构一致：完整的start/stop XML、gpt_out和4个向量
+    events_path = os.path.join(path, "events")
+    os.makedirs(events_path)
+    xml = '<hierarchy>' + '<node class="android.widget.TextView" text="item" bounds="[0,0][100,100]"/>' * 200 + \
+          '</hierarchy>'
+    scene_count = max(2, event_count // 5)
+    # 每个控件出现在两个事件中，两次的到达场景、动作名称和bounds不同，ACTION_SCENE_PAIR的值各不相同
+    view_count = max(1, event_count // 2)
+    for i in range(event_count):
+        event_data = {
+            'event': {'event_type': 'touch' if i < view_count else 'long_touch',
+                      'view': {'view_str': f"view-{i % view_count}", 'bounds': [[0, 0], [100, 100 + i]]}},
+            'start_state': f"state-{i % scene_count}", 'stop_state': f"state-{(i + 1) % scene_count}",
+            'start_xml': xml, 'stop_xml': xml,
+            'gpt_out': {'previous_page_name': f"page {i % scene_count}", 'previous_page_description': "",
+                        'current_page_name': f"page {(i + 1) % scene_count}", 'current_page_description': "",
+                        'action_name': f"action {i}", 'action_description': ""},
+            'embedding': {name: rng.standard_normal(dim).tolist() for name in
+                          ['previous_page_name_embedding', 'current_page_name_embedding', 'action_name_embedding',
+                           'action_description_embedding']},
+        }
+        with open(os.path.join(events_path, f"event_{i}.json"), 'w') as f:
+            json.dump(event_data, f)
+
+
+def reset_pre_data():
+    for table in [execute_agent.Scene_hash_dict, execute_agent.Action_hash_dict, execute_agent.ACTION_SCENE_PAIR]:
+        table.clear()
+
+
+def pre_data_state(agent, query, k):
+    """
+    ExecuteAgent加载后的检索数据：动作表和ACTION_SCENE_PAIR的值（不含向量）、两者归一化的向量，以及检索结果
+    """
+    def fields(info):
+        return {field: value for field, value in info.items() if field != 'embedding'}
+
+    actions, pairs = execute_agent.Action_hash_dict, execute_agent.ACTION_SCENE_PAIR
+    data = ({key: fields(info) for key, info in actions.items()},
+            {key: fields(info) for key, info in pairs.items()},
+            [hash_id for hash_id, _ in agent.action_index.search(query, k)],
+            [hash_id for hash_id, _ in agent.scene_index.search(query, k)])
+    vectors = normalize([info['embedding'] for info in list(actions.values()) + list(pairs.values())])
+    return data, vectors
+
+
+def same_pre_data(a, b):
+    return a[0] == b[0] and np.allclose(a[1], b[1], atol=1e-6)
+
+
+def bench_startup(event_count, dim, k=10):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as path:
+        write_synthetic_events(path, event_count, dim, rng)
+        agent = execute_agent.ExecuteAgent()
+        query = rng.standard_normal(dim)
+        results = []
+        for name, run in [("parse events", lambda: agent.load_events(path)),
+                          ("compile snapshot", lambda: agent.compile_snapshot(path)),
+                          ("load snapshot", lambda: agent.build_pre_data(path))]:
+            reset_pre_data()
+            start = time.perf_counter()
+            run()
+            if name != "load snapshot":
+                agent.scene_index = EmbeddingIndex.from_dict(execute_agent.Scene_hash_dict)
+                agent.action_index = EmbeddingIndex.from_dict(execute_agent.Action_hash_dict)
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {elapsed:.3f}s")
+            results.append(pre_data_state(agent, query, k))
+        same = all(same_pre_data(result, results[0]) for result in results)
+        print(f"events: {event_count}, actions: {len(execute_agent.Action_hash_dict)}, "
+              f"pairs: {len(execute_agent.ACTION_SCENE_PAIR)}, scenes: {len(execute_agent.Scene_hash_dict)}, "
+              f"same actions, pairs and top-{k}: {same}")
+        assert same, "snapshot start differs from parsing the events"
+        # 事件目录变化后快照失效
+        with open(os.path.join(path, "events", "event_0.json"), 'a') as f:
+            f.write(' ')
+        reset_pre_data()
+        start = time.perf_counter()
+        agent.build_pre_data(path)
+        print(f"after an event file changed, build_pre_data recompiled in {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ExecuteAgent candidate retrieval on a synthetic graph")
+    parser.add_argument("bench", choices=["retrieve", "ann", "startup"])
+    parser.add_argument("--actions", type=int, default=0,
+                        help="50000 for retrieve, 200000 for ann, 1000 events for startup")
+    parser.add_argument("--dim", type=int, default=0, help="1536 for retrieve, 256 for ann")
+    parser.add_argument("--steps", type=int, default=0, help="20 for retrieve, 200 for ann")
+    parser.add_argument("--noise", type=float, default=1.0, help="within-cluster noise of the ann embeddings")
+    args = parser.parse_args()
+    if args.bench == "retrieve":
+        bench_retrieve(args.actions or 50000, args.dim or 1536, args.steps or 20)
+    elif args.bench == "ann":
+        bench_ann(args.actions or 200000, args.dim or 256, args.steps or 200, noise=args.noise)
+    elif args.bench == "startup":
+        bench_startup(args.actions or 1000, args.dim or 1536)
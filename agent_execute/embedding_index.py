@@ -0,0 +1,325 @@
+import os
+import numpy as np
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    # 零向量保持为0，与任何查询的相似度都为0
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    :return: scores中最大的k个值的下标，按分数从高到低排列
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class EmbeddingIndex:
+    """
+    hash -> 向量 的内存检索索引：向量预先归一化后按行存放在连续的float32矩阵中，
+    余弦相似度即为与归一化查询向量的点积；hash和行号互相映射，限定候选子集时按hash O(1)取行号
+    """
+
+    def __init__(self, keys, vectors):
+        self.keys = list(keys)
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        if self.keys:
+            matrix = np.asarray(vectors, dtype=np.float32).reshape(len(self.keys), -1)
+            self._data = np.ascontiguousarray(normalize(matrix))
+        else:
+            self._data = np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_dict(cls, hash_dict, field='embedding', **kwargs):
+        """
+        由 Scene_hash_dict / Action_hash_dict 构建，行号与字典的插入顺序一致
+        """
+        return cls(hash_dict.keys(), [value[field] for value in hash_dict.values()], **kwargs)
+
+    @classmethod
+    def from_matrix(cls, keys, matrix):
+        """
+        直接使用已归一化的矩阵（例如内存映射的快照），不复制数据
+        """
+        index = cls.__new__(cls)
+        index.keys = list(keys)
+        index.rows = {key: row for row, key in enumerate(index.keys)}
+        index._data = matrix
+        return index
+
+    @property
+    def matrix(self):
+        return self._data[:len(self.keys)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _reserve(self, size, dim):
+        # 按倍数扩容，逐个插入的均摊开销为O(d)
+        if self._data.shape[1] != dim:
+            if len(self.keys):
+                raise ValueError(f"embedding dim {dim} does not match index dim {self._data.shape[1]}")
+            self._data = np.zeros((0, dim), dtype=np.float32)
+        if size > self._data.shape[0]:
+            data = np.zeros((max(size, 2 * self._data.shape[0], 16), dim), dtype=np.float32)
+            data[:len(self.keys)] = self.matrix
+            self._data = data
+
+    def add(self, key, vector):
+        """
+        插入一个向量，key已存在时覆盖原来的向量
+        :return: key所在的行号
+        """
+        vector = normalize(np.asarray(vector, dtype=np.float32).reshape(-1))
+        if key in self.rows:
+            row = self.rows[key]
+        else:
+            self._reserve(len(self.keys) + 1, len(vector))
+            row = len(self.keys)
+            self.rows[key] = row
+            self.keys.append(key)
+        self._data[row] = vector
+        return row
+
+    def remove(self, key):
+        """
+        删除一个向量，最后一行移动到被删除的行
+        :return: (被删除的行号, 原来的最后一行行号)，key不存在时返回None
+        """
+        if key not in self.rows:
+            return None
+        row, last = self.rows.pop(key), len(self.keys) - 1
+        if row != last:
+            self._data[row] = self._data[last]
+            self.keys[row] = self.keys[last]
+            self.rows[self.keys[row]] = row
+        self.keys.pop()
+        return row, last
+
+    def rows_for(self, keys):
+        """
+        :return: keys中存在于索引的hash对应的行号，保持keys的顺序
+        """
+        return np.array([self.rows[key] for key in keys if key in self.rows], dtype=np.int64)
+
+    def _query(self, vector):
+        return normalize(np.asarray(vector, dtype=np.float32).reshape(-1))
+
+    def search(self, vector, k, rows=None):
+        """
+        :param rows: 只在这些行中检索，None表示全部
+        :return: 按相似度从高到低排列的 [(hash, 相似度)]，最多k个
+        """
+        if len(self.keys) == 0:
+            return []
+        query = self._query(vector)
+        if rows is None:
+            scores = self.matrix @ query
+            return [(self.keys[i], float(scores[i])) for i in top_k(scores, k)]
+        scores = self.matrix[rows] @ query
+        return [(self.keys[rows[i]], float(scores[i])) for i in top_k(scores, k)]
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    倒排文件(IVF)近似检索索引：用球面k-means把向量分到n_lists个簇，查询时只在与查询最相似的probe个簇内精确计算，
+    限定候选行号的检索（如某场景的出边）候选集很小，仍然精确计算。
+    新插入的向量直接分配到最近的簇，规模增长到训练时的2倍后重新训练簇中心。
+    n_probe为0时，每次训练后用索引中向量附近的查询估计recall@10，自动选择达到target_recall的探查簇数
+    """
+
+    def __init__(self, keys, vectors, n_lists=0, n_probe=0, seed=0, target_recall=0.95):
+        super().__init__(keys, vectors)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.target_recall = target_recall
+        # 实际探查的簇数和估计的recall@10，由calibrate()确定
+        self.probe = n_probe
+        self.recall = None
+        self.centroids = None
+        self.trained_size = 0
+        self._assignments = np.zeros(self._data.shape[0], dtype=np.int32)
+        self._lists = None
+        if len(self.keys):
+            self.train()
+
+    def train(self, iterations=10):
+        n = len(self.keys)
+        # 默认簇数约为sqrt(n)，每簇平均约sqrt(n)个向量
+        n_lists = min(n, self.n_lists or max(1, int(np.sqrt(n))))
+        rng = np.random.default_rng(self.seed)
+        sample = self.matrix[rng.choice(n, min(n, 256 * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # 空簇保留原来的中心
+            centroids = np.where(counts[:, None] > 0, normalize(sums), centroids)
+        self.centroids = np.ascontiguousarray(centroids)
+        self._assignments[:n] = self._assign(self.matrix)
+        self.trained_size = n
+        self._lists = None
+        self.calibrate()
+
+    def _search_rows(self, query, k, probe):
+        lists = self.lists()
+        candidates = np.concatenate([lists[i] for i in top_k(self.centroids @ query, probe)])
+        scores = self.matrix[candidates] @ query
+        top = top_k(scores, k)
+        return candidates[top], scores[top]
+
+    def recall_sample(self, k=10, sample=100):
+        """
+        从索引中随机抽取向量，加上模长等于其到最近邻距离的随机扰动作为查询：实际的查询（用例步骤的描述）
+        不会与图中的节点完全相同，直接用节点本身查询会高估recall
+        :return: (查询矩阵, 每个查询精确检索的前k个行号)
+        """
+        n = len(self.keys)
+        rng = np.random.default_rng(self.seed)
+        rows = rng.choice(n, min(n, sample), replace=False)
+        vectors = self.matrix[rows]
+        exact_scores = vectors @ self.matrix.T
+        nearest = [top_k(scores, 2)[-1] for scores in exact_scores]
+        distances = np.linalg.norm(vectors - self.matrix[nearest], axis=1, keepdims=True)
+        noise = normalize(rng.standard_normal(vectors.shape).astype(np.float32)) * distances
+        queries = normalize(vectors + noise)
+        return queries, [set(top_k(self.matrix @ query, k).tolist()) for query in queries]
+
+    def estimate_recall(self, probe, sample=None):
+        """
+        估计探查probe个簇时相对精确检索的recall@10
+        """
+        queries, truth = sample if sample is not None else self.recall_sample()
+        found = 0.0
+        for query, expected in zip(queries, truth):
+            approx = set(self._search_rows(query, len(expected), probe)[0].tolist())
+            found += len(expected & approx) / len(expected)
+        return found / len(queries)
+
+    def calibrate(self):
+        """
+        n_probe为0时从sqrt(n_lists)起成倍增加探查簇数，直到估计的recall达到target_recall；
+        数据缺少簇结构时需要探查大部分簇才能达到目标，近似检索几乎没有加速，打印提示
+        """
+        n_lists = len(self.centroids)
+        sample = self.recall_sample()
+        if self.n_probe:
+            self.probe = min(self.n_probe, n_lists)
+            self.recall = self.estimate_recall(self.probe, sample)
+        else:
+            self.probe = min(n_lists, max(1, int(round(np.sqrt(n_lists)))))
+            self.recall = self.estimate_recall(self.probe, sample)
+            while self.recall < self.target_recall and self.probe < n_lists:
+                self.probe = min(n_lists, 2 * self.probe)
+                self.recall = self.estimate_recall(self.probe, sample)
+        if self.recall < self.target_recall:
+            print(f"ann index: estimated recall@10 {self.recall:.3f} with {self.probe}/{n_lists} lists probed is "
+                  f"below {self.target_recall}, set [execute] ann_probe = 0 or disable ann")
+        elif self.probe > n_lists // 2:
+            print(f"ann index: {self.probe}/{n_lists} lists probed for recall@10 {self.recall:.3f}, the embeddings "
+                  f"are poorly clustered and exact retrieval is about as fast")
+
+    def _assign(self, vectors, chunk=8192):
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for i in range(0, len(vectors), chunk):
+            labels[i:i + chunk] = np.argmax(vectors[i:i + chunk] @ self.centroids.T, axis=1)
+        return labels
+
+    def _reserve(self, size, dim):
+        super()._reserve(size, dim)
+        if self._assignments.shape[0] < self._data.shape[0]:
+            assignments = np.zeros(self._data.shape[0], dtype=np.int32)
+            assignments[:len(self._assignments)] = self._assignments
+            self._assignments = assignments
+
+    def add(self, key, vector):
+        row = super().add(key, vector)
+        if self.centroids is None or len(self.keys) >= 2 * self.trained_size:
+            self.train()
+        else:
+            self._assignments[row] = self._assign(self._data[row:row + 1])[0]
+            self._lists = None
+        return row
+
+    def remove(self, key):
+        moved = super().remove(key)
+        if moved is not None:
+            row, last = moved
+            self._assignments[row] = self._assignments[last]
+            self._lists = None
+        return moved
+
+    def lists(self):
+        # 每个簇包含的行号，插入或删除后按需重建
+        if self._lists is None:
+            assignments = self._assignments[:len(self.keys)]
+            order = np.argsort(assignments, kind='stable')
+            bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        return self._lists
+
+    def search(self, vector, k, rows=None, n_probe=None):
+        if rows is not None or self.centroids is None:
+            return super().search(vector, k, rows)
+        found, scores = self._search_rows(self._query(vector), k, n_probe or self.probe)
+        return [(self.keys[row], float(score)) for row, score in zip(found, scores)]
+
+    def sync(self, hash_dict, field='embedding'):
+        """
+        把持久化的索引与当前的 hash_dict 对齐：插入新增的节点、更新向量变化的节点、删除已不存在的节点
+        :return: (新增数, 更新数, 删除数)
+        """
+        removed = [key for key in self.keys if key not in hash_dict]
+        for key in removed:
+            self.remove(key)
+        added, updated = 0, 0
+        existing = [key for key in hash_dict if key in self.rows]
+        if existing:
+            stored = self.matrix[self.rows_for(existing)]
+            current = normalize([hash_dict[key][field] for key in existing])
+            changed = np.flatnonzero(np.abs(stored - current).max(axis=1) > 1e-6)
+            for i in changed:
+                self.add(existing[i], hash_dict[existing[i]][field])
+            updated = len(changed)
+        for key, value in hash_dict.items():
+            if key not in self.rows:
+                self.add(key, value[field])
+                added += 1
+        return added, updated, len(removed)
+
+    def save(self, path):
+        if self.centroids is None:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, keys=np.array(self.keys, dtype=str), matrix=self.matrix, centroids=self.centroids,
+                 assignments=self._assignments[:len(self.keys)],
+                 params=np.array([self.n_lists, self.n_probe, self.seed, self.trained_size, self.probe]),
+                 recall=np.array([self.target_recall, self.recall]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls.__new__(cls)
+            index.keys = data['keys'].tolist()
+            index.rows = {key: row for row, key in enumerate(index.keys)}
+            index._data = np.ascontiguousarray(data['matrix'])
+            index.centroids = data['centroids']
+            index._assignments = data['assignments'].astype(np.int32)
+            index.n_lists, index.n_probe, index.seed, index.trained_size, index.probe = \
+                (int(v) for v in data['params'])
+            index.target_recall, index.recall = (float(v) for v in data['recall'])
+            index._lists = None
+        return index
@@ -2,14 +2,15 @@ import json
 import time
 import os
 
-import numpy as np
 from natsort import natsorted
-from itertools import islice
-from sklearn.metrics.pairwise import cosine_similarity
-from core.graph_manager import GraphManager
-from core.azure_gpt4 import ask_gpt4o
+from core.graph_manager import create_graph_manager, GraphReadCache
+from core.azure_gpt4 import ask_gpt4o, get_llm_cache, get_scheduler
 from core.embedding import embeddings
+from core.llm_client import get_llm_client, load_config
+from core.rate_limit import PRIORITY_EXECUTE
 from core.utils import print_with_color
+from agent_execute.embedding_index import EmbeddingIndex, IVFIndex
+from agent_execute.snapshot import SNAPSHOT_DIR, events_fingerprint, load_snapshot, save_snapshot
 from agent_execute.prompts.execute_prompt import *
 
 Scene_hash_dict, Action_hash_dict, ACTION_SCENE_PAIR = {}, {}, {}
@@ -17,69 +18,73 @@ Scene_hash_dict, Action_hash_dict, ACTION_SCENE_PAIR = {}, {}, {}
 
 class ExecuteAgent:
     def __init__(self):
-        pass
+        self.scene_index = None
+        self.action_index = None
 
-    def get_node_info(self, index, type, matched_embedding='', candidates_index_list=[]):
-        try:
-            if type == 'scene':
-                key, value = next(islice(Scene_hash_dict.items(), index, None))
-                return {
-                    "scene_hash": key,
-                    "page_name": value['page_name'],
-                    "page_description": value['page_description']
-                }
-            elif type == 'action':
-                if len(candidates_index_list) == 0:
-                    for key, value in Action_hash_dict.items():
-                        if value['embedding'] == matched_embedding:
-                            return {
-                                "action_hash": key,
-                                "action_name": value['action_name'],
-                                "action_description": value['action_description']
-                            }
-                    return {
-                        "action_hash": "No Match"
-                    }
-                else:
-                    key, value = next(islice(Action_hash_dict.items(), candidates_index_list[index], None))
-                    return {
-                        "action_hash": key,
-                        "action_name": value['action_name'],
-                        "action_description": value['action_description']
-                    }
-        except StopIteration:
-            return None  # or raise an exception, or handle the case as needed
+    def get_node_info(self, hash_id, type):
+        if type == 'scene':
+            value = Scene_hash_dict[hash_id]
+            return {
+                "scene_hash": hash_id,
+                "page_name": value['page_name'],
+                "page_description": value['page_description']
+            }
+        elif type == 'action':
+            value = Action_hash_dict[hash_id]
+            return {
+                "action_hash": hash_id,
+                "action_name": value['action_name'],
+                "action_description": value['action_description']
+            }
 
     def get_candidate(self, type, action_hash_list=[]):
-        candidates = []
-        candidates_index_list = []
-        num = 0
+        """
+        :return: 候选节点所在的向量索引，以及候选集在索引中的行号（None表示全部节点）
+        """
         if type == "scene":
-            for key, value in Scene_hash_dict.items():
-                candidates.append(value['embedding'])
-        elif type == "action":
-            if len(action_hash_list) != 0:
-                for node in action_hash_list:
-                    action_index = 0
-                    for key, value in Action_hash_dict.items():
-                        if key == node['hash_id']:
-                            candidates.append(value["embedding"])
-                            candidates_index_list.append(action_index)
-                            break
-                        action_index += 1
-                if len(candidates) == 0:
-                    print("给定的出边候选集没有在候选集中匹配上，选取全部候选集")
-                    # 标注完的集合中没有对应的动作节点，那么把所有的候选集都加入
-                    for key, value in Action_hash_dict.items():
-                        candidates.append(value['embedding'])
-            else:  # 当没有候选动作节点时
-                for key, value in Action_hash_dict.items():
-                    candidates.append(value['embedding'])
-        return candidates, candidates_index_list
+            return self.scene_index, None
+        rows = None
+        if len(action_hash_list) != 0:
+            rows = self.action_index.rows_for(node['hash_id'] for node in action_hash_list)
+            if len(rows) == 0:
+                print("给定的出边候选集没有在候选集中匹配上，选取全部候选集")
+                # 标注完的集合中没有对应的动作节点，那么把所有的候选集都加入
+                rows = None
+        return self.action_index, rows
 
     def build_pre_data(self, path):
+        """
+        加载检索所需的场景、动作信息：事件目录未变化时直接内存映射编译好的快照，否则解析事件文件并重新编译快照
+        """
         start_time = time.time()
-        num_scene, num_action = 0, 0
+        scene_matrix, action_matrix = None, None
+        use_snapshot = load_config().getboolean('execute', 'snapshot', fallback=True)
+        snapshot = load_snapshot(path, events_fingerprint(path)) if use_snapshot else None
+        if snapshot is not None:
+            scenes, actions, pairs, scene_matrix, action_matrix = snapshot
+            Scene_hash_dict.update(scenes)
+            Action_hash_dict.update(actions)
+            ACTION_SCENE_PAIR.update(pairs)
+            print(f"load execute snapshot from {os.path.join(path, SNAPSHOT_DIR)}")
+        elif use_snapshot:
+            self.compile_snapshot(path)
+        else:
+            self.load_events(path)
+        self.scene_index = self.build_index(path, "scene", Scene_hash_dict, scene_matrix)
+        self.action_index = self.build_index(path, "action", Action_hash_dict, action_matrix)
+        end_time = time.time()
+        execution_time = end_time - start_time
+        print(f"Load Hive Data Execution time: {execution_time} seconds")
+
+    def compile_snapshot(self, path):
+        """
+        解析事件文件并编译为检索快照，指纹在解析前计算，解析期间事件目录发生变化时下次运行会重新编译
+        """
+        fingerprint = events_fingerprint(path)
+        self.load_events(path)
+        save_snapshot(path, fingerprint, Scene_hash_dict, Action_hash_dict, ACTION_SCENE_PAIR)
+
+    def load_events(self, path):
         events_path = os.path.join(path, "events")
         for event in natsorted(os.listdir(events_path)):
             if not event.endswith('.json'):
@@ -116,9 +121,40 @@ class ExecuteAgent:
                 'action_type': event_data['event']['event_type']
             }
             ACTION_SCENE_PAIR[view_str, stop_state] = Action_hash_dict[view_str]
-        end_time = time.time()
-        execution_time = end_time - start_time
-        print(f"Load Hive Data Execution time: {execution_time} seconds")
+
+    def build_index(self, path, name, hash_dict, matrix=None):
+        """
+        节点数不少于[execute] ann_min_size时使用IVF近似检索索引，持久化在输出目录的embedding_index下，
+        下次运行时加载并增量同步新增和变化的节点，否则使用精确检索索引
+        :param matrix: 快照中与hash_dict行序一致的归一化矩阵，精确检索时直接使用
+        """
+        config = load_config()
+        if not config.getboolean('execute', 'ann', fallback=False) or \
+                len(hash_dict) < config.getint('execute', 'ann_min_size', fallback=20000):
+            if matrix is not None and len(matrix) == len(hash_dict):
+                return EmbeddingIndex.from_matrix(hash_dict.keys(), matrix)
+            return EmbeddingIndex.from_dict(hash_dict)
+        index_path = os.path.join(path, "embedding_index", f"{name}_ivf.npz")
+        n_probe = config.getint('execute', 'ann_probe', fallback=0)
+        target_recall = config.getfloat('execute', 'ann_recall', fallback=0.95)
+        if os.path.exists(index_path):
+            index = IVFIndex.load(index_path)
+            # 配置的探查簇数或目标recall变化时重新校准
+            recalibrate = (index.n_probe, index.target_recall) != (n_probe, target_recall)
+            if recalibrate:
+                index.n_probe, index.target_recall = n_probe, target_recall
+                index.calibrate()
+            added, updated, removed = index.sync(hash_dict)
+            print(f"load {name} ann index: {len(index)} nodes, added {added}, updated {updated}, removed {removed}")
+            if recalibrate or added or updated or removed:
+                index.save(index_path)
+        else:
+            index = IVFIndex.from_dict(hash_dict, n_lists=config.getint('execute', 'ann_lists', fallback=0),
+                                       n_probe=n_probe, target_recall=target_recall)
+            index.save(index_path)
+            print(f"build {name} ann index: {len(index)} nodes, {len(index.centroids)} lists, probe {index.probe}, "
+                  f"estimated recall@10 {index.recall:.3f}")
+        return index
 
     def generate_executable_code(self, item_path, matched_node_list):
         action_index = 0
@@ -245,7 +281,7 @@ class ExecuteAgent:
         return ACTION_SCENE_PAIR[(last_action_hash, scene_hash)]
 
     def generate_code_from_cases(self, test_cases_path):
-        graph_manager = GraphManager("ankidroidgraph")
+        graph_manager = create_graph_manager("ankidroidgraph")
         candidate_number = 10
         # 定义不想包含的前缀
         prefixes = ['case-base', 'case-hard', 'case-finished']
@@ -256,51 +292,49 @@ class ExecuteAgent:
                 a list of all nodes to be matched, including the name and hash of each node'''
                 start_time = time.time()
                 full_case, correct_node_list = self.get_full_case_v2(item_path)
+                graph_reader = GraphReadCache(graph_manager)
                 print(full_case)
                 node_index, matched_node_list, action_hash_list = 0, [], []
                 # 过滤.开头的文件和不是文件夹的
                 while node_index < len(correct_node_list):  # 有第一个场景节点
                     matching_node = correct_node_list[node_index]
                     if matching_node['type'] == 'scene':
-                        candidates_embedding_list, _ = self.get_candidate("scene")
-                        candidate_num = 15 if len(candidates_embedding_list) >= 15 else len(
-                            candidates_embedding_list)
+                        candidate_index, candidate_rows = self.get_candidate("scene")
+                        candidate_num = 15
                         matching_word = matching_node['scene_name']
                     else:
                         last_matched_node = matched_node_list[len(matched_node_list) - 1]
                         if 'out_scene_hash' in last_matched_node:
                             out_scene_hash = last_matched_node['out_scene_hash']
-                            action_hash_list = graph_manager.get_outgoing_actions(out_scene_hash)
+                            action_hash_list = graph_reader.get_outgoing_actions(out_scene_hash)
                             print("action_arrival_scene_hash", out_scene_hash)
                         elif 'scene_hash' in last_matched_node:
                             out_scene_hash = last_matched_node['scene_hash']
-                            action_hash_list = graph_manager.get_outgoing_actions(out_scene_hash)
+                            action_hash_list = graph_reader.get_outgoing_actions(out_scene_hash)
                             print("action_arrival_scene_hash", out_scene_hash)
                         else:
                             action_hash_list = []
-                        candidates_embedding_list, candidates_index_list = self.get_candidate("action", action_hash_list)
-                        print("动作候选集数量: ", len(candidates_embedding_list))
-                        candidate_num = candidate_number if len(candidates_embedding_list) >= candidate_number else len(
-                            candidates_embedding_list)
+                        candidate_index, candidate_rows = self.get_candidate("action", action_hash_list)
+                        print("动作候选集数量: ", len(candidate_index) if candidate_rows is None else len(candidate_rows))
+                        candidate_num = candidate_number
                         matching_word = matching_node['action_name']
-                    target = embeddings([matching_word])
-                    similarity_scores = cosine_similarity(target, candidates_embedding_list)
-                    # 找出前n个最高相似度的索引
-                    top_same_indices = np.argsort(similarity_scores[0])[-candidate_num:][::-1]
+                    target = embeddings([matching_word], priority=PRIORITY_EXECUTE)
+                    # 找出前n个最高相似度的节点
+                    top_matches = candidate_index.search(target[0], candidate_num, candidate_rows)
                     if matching_node['type'] == 'scene':
                         print_with_color(f"-------------开始匹配场景节点: {matching_word}, node index: {node_index}, sum: {len(correct_node_list) - 1}-------------", "cyan")
                         candidates_list = []
                         scene_list = []
                         best_node = None
-                        for idx in top_same_indices:
-                            node_info = self.get_node_info(idx, 'scene')
-                            node_info['similarity'] = similarity_scores[0][idx]
+                        for hash_id, similarity in top_matches:
+                            node_info = self.get_node_info(hash_id, 'scene')
+                            node_info['similarity'] = similarity
                             candidates_list.append(node_info)
                             scene_list.append(node_info['scene_hash'])
-                            # print(f"索引：{idx}, 名称: {node_info['page_name']}, 相似度分数：{similarity_scores[0][idx]}, scene_hash: {node_info['scene_hash']}，描述：{node_info['page_description']}")
+                            # print(f"名称: {node_info['page_name']}, 相似度分数：{similarity}, scene_hash: {node_info['scene_hash']}，描述：{node_info['page_description']}")
                         # print(candidates_list)
                         # 从图数据库中筛选并获取场景节点的信息
-                        scene_info_list = graph_manager.get_info_from_scene_list(scene_list)
+                        scene_info_list = graph_reader.get_info_from_scene_list(scene_list)
                         scene_info_prompt = ""
                         scene_index = 0
                         for node in scene_info_list:
@@ -316,7 +350,7 @@ class ExecuteAgent:
                             # print(node)
                         prompt = SCENE_PROMPT.format(matching_word=matching_word, candidate=scene_info_prompt, full_case=full_case)
                         print(prompt)
-                        gpt_out = ask_gpt4o("", prompt, [], True)
+                        gpt_out = ask_gpt4o("", prompt, [], True, priority=PRIORITY_EXECUTE)
                         print_with_color(str(gpt_out), "green")
                         gpt_choose_index = gpt_out['index']
                         choose_node_info = candidates_list[gpt_choose_index]
@@ -334,15 +368,17 @@ class ExecuteAgent:
                         print_with_color(f"-------------开始匹配动作节点: {matching_word}, node index: {node_index}, sum: {len(correct_node_list) - 1}, 匹配次数：{matching_node['back_trace_num']}-------------", "cyan")
                         candidates_list = []
                         action_list = []
-                        print(f"The {candidate_num} most matching vector indices and similarity scores")
-                        for idx in top_same_indices:
-                            node_info = self.get_node_info(idx, 'action', candidates_embedding_list[idx], candidates_index_list)
-                            node_info['similarity'] = similarity_scores[0][idx]
+                        print(f"The {len(top_matches)} most matching vector indices and similarity scores")
+                        for hash_id, similarity in top_matches:
+                            node_info = self.get_node_info(hash_id, 'action')
+                            node_info['similarity'] = similarity
                             candidates_list.append(node_info)
                             action_list.append(node_info['action_hash'])
-                            # print(f"索引：{idx}, 名称: {node_info['action_name']}, 相似度分数：{similarity_scores[0][idx]}, action_hash: {node_info['action_hash']}，描述：{node_info['action_description']}")
+                            # print(f"名称: {node_info['action_name']}, 相似度分数：{similarity}, action_hash: {node_info['action_hash']}，描述：{node_info['action_description']}")
                         # Filter and retrieve information on action nodes from the graph database
-                        action_info_list = graph_manager.get_info_from_action_list(action_list)
+                        # 动作信息和每个动作到达的场景由一次批量查询得到，回退后重复的候选直接读缓存
+                        action_info_list = graph_reader.get_info_from_action_list(action_list)
+                        arrival_scenes = {node['hash_id']: node.pop('arrival_scene') for node in action_info_list}
                         send_gpt_action_content, gpt_index = "", 1
                         frequency_threshold = 0
                         filtered_action_info_list = []
@@ -361,7 +397,7 @@ class ExecuteAgent:
                                     node['action_description'] = match['action_description']
                                     node['similarity'] = match['similarity']
                                     # 对于候选集的所有动作节点，获取它对应到达的场景hash，再获取到达场景的语义，加入gpt，并加入整条case
-                                    out_scene_info = graph_manager.get_scene_by_action_hash_id(node['hash_id'])
+                                    out_scene_info = arrival_scenes[node['hash_id']]
                                     if out_scene_info is None:
                                         continue
                                     out_scene_hash = out_scene_info['hash_id']
@@ -377,7 +413,7 @@ class ExecuteAgent:
                             send_gpt_action_content += tmp_gpt_node
                         prompt = ACTION_PROMPT.format(matching_word=matching_word, candidate=send_gpt_action_content, full_case=full_case)
                         print(prompt)
-                        gpt_out = ask_gpt4o("", prompt, [], True)
+                        gpt_out = ask_gpt4o("", prompt, [], True, priority=PRIORITY_EXECUTE)
                         print_with_color(str(gpt_out), "green")
                         if gpt_out is None:
                             print("gpt respond error, Set the action candidate set to all")
@@ -452,6 +488,12 @@ class ExecuteAgent:
                 end_time = time.time()
                 execution_time = end_time - start_time
                 print(f"Generate Code time: {execution_time} seconds")
+                llm_cache = get_llm_cache()
+                if llm_cache is not None:
+                    print(f"llm cache: {llm_cache.stats()}")
+                print(f"graph read cache: {graph_reader.stats()}")
+                print(f"llm client: {get_llm_client().stats()}")
+                print(f"llm scheduler: {get_scheduler().stats()}")
                 break  # only generate one case for demonstration
 
 
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import numpy as np
+from agent_execute.embedding_index import normalize
+
+'''
+ExecuteAgent的检索快照：build_pre_data从事件文件中提取的场景、动作信息编译为
+<output_dir>/execute_snapshot 下的
+  scene_embeddings.npy / action_embeddings.npy  归一化后的float32向量矩阵，行号与meta中的顺序一致
+  pair_action_embeddings.npy                    只被ACTION_SCENE_PAIR引用、已被后续事件覆盖的动作的向量
+  meta.json                                     事件目录指纹、场景和动作的元数据表、(view_str, stop_state)对及其动作信息的行号
+之后的运行以内存映射方式加载，事件目录变化时指纹不一致，快照自动失效
+'''
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_DIR = "execute_snapshot"
+SCENE_FIELDS = ['page_name', 'page_description']
+ACTION_FIELDS = ['action_name', 'action_description', 'bounds', 'action_type']
+
+
+def events_fingerprint(path):
+    """
+    事件目录的指纹：只读取目录项的文件名、大小和修改时间，不读取文件内容
+    """
+    digest = hashlib.sha256(f"v{SNAPSHOT_VERSION}".encode('utf-8'))
+    events_path = os.path.join(path, "events")
+    entries = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                     for entry in os.scandir(events_path) if entry.name.endswith('.json'))
+    for name, size, mtime in entries:
+        digest.update(f"{name}\0{size}\0{mtime}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def save_snapshot(path, fingerprint, scenes, actions, pairs):
+    """
+    :param scenes: Scene_hash_dict
+    :param actions: Action_hash_dict
+    :param pairs: ACTION_SCENE_PAIR，每一对的值为其所在事件的动作信息，可能与Action_hash_dict中同一view_str的最终值不同
+    """
+    snapshot_path = os.path.join(path, SNAPSHOT_DIR)
+    os.makedirs(snapshot_path, exist_ok=True)
+    # 先删除旧的meta，写出过程中断时不会把新的向量矩阵和旧的元数据当作一份快照
+    if os.path.exists(os.path.join(snapshot_path, "meta.json")):
+        os.remove(os.path.join(snapshot_path, "meta.json"))
+    # 动作信息按对象去重：与Action_hash_dict共用的指向动作表的行，其余追加到pair_actions表，行号接在动作表之后
+    action_rows = {id(value): row for row, value in enumerate(actions.values())}
+    pair_actions, pair_rows = [], []
+    for (view_str, stop_state), value in pairs.items():
+        if id(value) not in action_rows:
+            action_rows[id(value)] = len(actions) + len(pair_actions)
+            pair_actions.append(value)
+        pair_rows.append([view_str, stop_state, action_rows[id(value)]])
+    for name, values in [("scene", list(scenes.values())), ("action", list(actions.values())),
+                         ("pair_action", pair_actions)]:
+        if values:
+            matrix = normalize([value['embedding'] for value in values])
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(snapshot_path, f"{name}_embeddings.npy"), matrix)
+    meta = {
+        "fingerprint": fingerprint,
+        "scenes": [[key] + [value[field] for field in SCENE_FIELDS] for key, value in scenes.items()],
+        "actions": [[key] + [value[field] for field in ACTION_FIELDS] for key, value in actions.items()],
+        "pair_actions": [[value[field] for field in ACTION_FIELDS] for value in pair_actions],
+        "pairs": pair_rows,
+    }
+    # meta最后写入，作为快照完整写出的标志
+    tmp_path = os.path.join(snapshot_path, "meta.json.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, os.path.join(snapshot_path, "meta.json"))
+
+
+def load_snapshot(path, fingerprint):
+    """
+    :return: (scenes, actions, pairs, scene_matrix, action_matrix)，快照不存在或已过期时返回None；
+             scenes / actions 中的embedding为内存映射矩阵中对应行的视图，
+             pairs为 (view_str, stop_state) -> 动作信息，与解析事件文件时一样，与actions共用同一个动作的字典
+    """
+    snapshot_path = os.path.join(path, SNAPSHOT_DIR)
+    meta_path = os.path.join(snapshot_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get("fingerprint") != fingerprint:
+        return None
+    tables = []
+    for name, rows, fields in [("scene", meta["scenes"], SCENE_FIELDS), ("action", meta["actions"], ACTION_FIELDS),
+                               ("pair_action", [[row] + values for row, values in enumerate(meta["pair_actions"])],
+                                ACTION_FIELDS)]:
+        matrix = np.load(os.path.join(snapshot_path, f"{name}_embeddings.npy"), mmap_mode='r')
+        if len(matrix) != len(rows):
+            return None
+        # 以普通ndarray视图访问映射的内存，逐行取视图时不再经过memmap子类
+        rows_view = np.asarray(matrix)
+        table = {}
+        for row, (key, *values) in enumerate(rows):
+            table[key] = dict(zip(fields, values), embedding=rows_view[row])
+        tables.append((table, matrix))
+    (scenes, scene_matrix), (actions, action_matrix), (pair_actions, _) = tables
+    action_values = list(actions.values()) + list(pair_actions.values())
+    pairs = {(view_str, stop_state): action_values[row] for view_str, stop_state, row in meta["pairs"]}
+    return scenes, actions, pairs, scene_matrix, action_matrix
@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tracemalloc
+import xml.etree.ElementTree as ET
+from natsort import natsorted
+from lxml import etree
+from xml_extract import UIXMLTree
+from tree_node import build_tree_from_xml
+from ui_hierarchy import UIHierarchy, get_reduce_cache
+from core.llm_client import LLMClientRegistry
+from core.rate_limit import LLMScheduler, PRIORITY_EXECUTE, PRIORITY_SEMANTIC
+
+'''
+基于录制的事件文件的性能基准，用法：
+python benchmark.py <output_dir> hierarchy [--limit N]
+python benchmark.py - xpath [--sizes 100,500,2000]
+python benchmark.py <output_dir|-> tree [--limit N] [--sizes 100,500,2000]
+python benchmark.py <output_dir|-> parse [--limit N] [--sizes 100,500,2000]
+python benchmark.py <output_dir> reduce [--limit N]
+python benchmark.py - recycle [--sizes 100,500,2000]
+python benchmark.py - llm [--limit N]
+python benchmark.py - schedule [--limit N]
+'''
+
+REDUCE_ARGS = dict(app_name="AnkiDroid", level=1, str_type="plain_text", remove_system_bar=True, use_bounds=False,
+                   merge_switch=False)
+
+
+def load_xml_list(path, limit=0):
+    xml_list = []
+    events_path = os.path.join(path, 'events')
+    for event in natsorted(os.listdir(events_path)):
+        if not event.endswith('.json'):
+            continue
+        with open(os.path.join(events_path, event), 'r') as f:
+            try:
+                event_data = json.load(f)
+            except Exception:
+                continue
+        if "view" not in event_data['event']:
+            continue
+        xml_list += [event_data['start_xml'], event_data['stop_xml']]
+        if 0 < limit <= len(xml_list) // 2:
+            break
+    return xml_list
+
+
+def timeit(func, xml_list):
+    start = time.perf_counter()
+    results = [func(xml) for xml in xml_list]
+    return time.perf_counter() - start, results
+
+
+def legacy_select_target_root_node(xml):
+    # SemanticAgent原来的select_target_root_node
+    root = ET.fromstring(xml)
+    for child in root:
+        if child.tag == "node" and child.get("package") in ["com.android.systemui", "com.github.uiautomator"]:
+            continue
+        return ET.tostring(child, encoding='unicode')
+    return None
+
+
+def legacy_check_webkit(xml):
+    # SemanticAgent原来的check_webKit
+    try:
+        root = ET.fromstring(xml)
+    except ET.ParseError:
+        return False
+    return bool(root.findall(".//node[@base-class='android.webkit.WebView']"))
+
+
+def legacy_hierarchy(xml):
+    # execute_description原来的做法：同一个XML分别被ET、lxml、xmltodict解析多次
+    reduced = UIXMLTree().process(legacy_select_target_root_node(xml), **REDUCE_ARGS)
+    tree = build_tree_from_xml(xml)
+    return reduced, sorted(tree.get_activity_list()), sorted(tree.get_fragment_list()), legacy_check_webkit(xml)
+
+
+def unified_hierarchy(xml):
+    hierarchy = UIHierarchy(xml)
+    return (hierarchy.reduce(**REDUCE_ARGS, use_cache=False), sorted(hierarchy.get_activity_list()),
+            sorted(hierarchy.get_fragment_list()), hierarchy.has_webview())
+
+
+def bench_hierarchy(xml_list):
+    legacy_time, legacy_results = timeit(legacy_hierarchy, xml_list)
+    unified_time, unified_results = timeit(unified_hierarchy, xml_list)
+    mismatch = sum(1 for a, b in zip(legacy_results, unified_results) if a != b)
+    print(f"xml count: {len(xml_list)}, mismatched results: {mismatch}")
+    print(f"legacy multi-parse: {legacy_time:.3f}s, unified single-parse: {unified_time:.3f}s, "
+          f"speedup: {legacy_time / unified_time:.2f}x")
+
+
+def recycler_xml(item_count, hierarchy=True, first_item=0):
+    # 模拟一个包含大量同构列表项的密集页面，列表嵌套在多层容器布局中
+    def node(cls, rid, text, bounds, children='', clickable="false", scrollable="false"):
+        return (f'<node class="{cls}" resource-id="{rid}" text="{text}" content-desc="" package="com.ichi2.anki" '
+                f'checkable="false" checked="false" clickable="{clickable}" enabled="true" focusable="{clickable}" '
+                f'focused="false" scrollable="{scrollable}" long-clickable="false" password="false" selected="false" '
+                f'visible-to-user="true" bounds="{bounds}">{children}</node>')
+
+    items = ''.join(
+        node("android.widget.LinearLayout", "com.ichi2.anki:id/item", "", f"[0,{i * 10}][100,{i * 10 + 10}]",
+             node("android.widget.TextView", "com.ichi2.anki:id/title", f"Card {i}", f"[0,{i * 10}][100,{i * 10 + 5}]") +
+             node("android.widget.ImageView", "", "", f"[0,{i * 10 + 5}][10,{i * 10 + 10}]"), clickable="true")
+        for i in range(first_item, first_item + item_count))
+    recycler = node("androidx.recyclerview.widget.RecyclerView", "com.ichi2.anki:id/list", "", "[0,0][100,100000]",
+                    items, scrollable="true")
+    # 列表外层的DecorView、ContentFrame等容器布局
+    root = recycler
+    for _ in range(10):
+        root = node("android.widget.FrameLayout", "", "", "[0,0][100,100000]", root)
+    return '<hierarchy>' + root + '</hierarchy>' if hierarchy else root
+
+
+def bench_xpath(sizes):
+    for size in sizes:
+        tree = UIXMLTree()
+        tree.root = etree.fromstring(recycler_xml(size).encode('utf-8'))
+        node_count = sum(1 for _ in tree.root.iter('node'))
+        start = time.perf_counter()
+        tree.xml_sparse()
+        elapsed = time.perf_counter() - start
+        print(f"list items: {size}, nodes: {node_count}, xml_sparse: {elapsed * 1000:.1f}ms, "
+              f"{elapsed / node_count * 1e6:.1f}us/node")
+
+
+def walk_tree(xml):
+    tree = build_tree_from_xml(xml)
+    tree.to_html()
+    for node in tree.get_all_nodes():
+        node.get_action_types()
+    tree.get_activity_list()
+    tree.get_fragment_list()
+    tree.get_layout_list()
+    return len(tree.get_all_nodes())
+
+
+def bench_tree(xml_list, sizes):
+    # 构建TreeNode树并执行to_html、get_action_types和get_*_list，单位节点耗时应与树的规模无关
+    cases = []
+    if xml_list:
+        cases.append((f"recorded dumps x{len(xml_list)}", xml_list))
+    cases += [(f"synthetic list items {size}", [recycler_xml(size, hierarchy=False)]) for size in sizes]
+    for name, xmls in cases:
+        start = time.perf_counter()
+        node_count = sum(walk_tree(xml) for xml in xmls)
+        elapsed = time.perf_counter() - start
+        print(f"{name}, nodes: {node_count}, tree walk: {elapsed * 1000:.1f}ms, {elapsed / node_count * 1e6:.1f}us/node")
+
+
+def bench_parse(xml_list, sizes):
+    # build_tree_from_xml的耗时和峰值内存（tracemalloc会拖慢执行，耗时单独测量）
+    cases = []
+    if xml_list:
+        cases.append((f"recorded dumps x{len(xml_list)}", xml_list))
+    cases += [(f"synthetic list items {size}", [recycler_xml(size, hierarchy=False)]) for size in sizes]
+    for name, xmls in cases:
+        start = time.perf_counter()
+        for xml in xmls:
+            build_tree_from_xml(xml)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        for xml in xmls:
+            tracemalloc.start()
+            tree = build_tree_from_xml(xml)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            del tree
+        print(f"{name}, parse: {elapsed * 1000:.1f}ms, max peak memory per dump: {peak / 1024:.0f}KiB")
+
+
+def bench_reduce(xml_list):
+    # 按事件顺序精简所有start_xml/stop_xml，对比不使用缓存和使用（初始为空的）精简文本缓存
+    uncached_time, uncached = timeit(lambda xml: UIHierarchy(xml).reduce(**REDUCE_ARGS, use_cache=False), xml_list)
+    cached_time, cached = timeit(lambda xml: UIHierarchy(xml).reduce(**REDUCE_ARGS), xml_list)
+    mismatch = sum(1 for a, b in zip(uncached, cached) if a != b)
+    print(f"xml count: {len(xml_list)}, mismatched results: {mismatch}")
+    print(f"without cache: {uncached_time:.3f}s, with cache: {cached_time:.3f}s, "
+          f"speedup: {uncached_time / cached_time:.2f}x")
+    print(f"reduce cache: {get_reduce_cache().stats()}")
+
+
+def legacy_merge_recycle_list(tree, recycle_nodes):
+    # 原来的实现：对每个待合并的子节点，与列表中已有的子节点逐个递归比较
+    for element in tree.root.iter():
+        if element.attrib.get('scrollable') == 'true':
+            for node in recycle_nodes:
+                if element.attrib['class'] == node.attrib['class'] and element.attrib['resource-id'] == node.attrib[
+                        'resource-id'] and element.attrib['func-desc'] == node.attrib['func-desc']:
+                    for child in list(node):
+                        if all(not tree.same_subtree(child, other) for other in list(element)):
+                            element.append(child)
+
+
+def bench_recycle(sizes):
+    # 把向下滚动半屏后的第二页列表合并到第一页中
+    for size in sizes:
+        results = []
+        for name, merge in [("legacy", legacy_merge_recycle_list), ("digest", UIXMLTree.merge_recycle_list)]:
+            pages = []
+            for first_item in [0, size // 2]:
+                tree = UIXMLTree()
+                tree.root = etree.fromstring(recycler_xml(size, first_item=first_item).encode('utf-8'))
+                tree.xml_sparse()
+                pages.append(tree)
+            recycle_nodes = [element for element in pages[1].root.iter() if element.attrib.get('scrollable') == 'true']
+            start = time.perf_counter()
+            merge(pages[0], recycle_nodes)
+            results.append((name, time.perf_counter() - start, etree.tostring(pages[0].root)))
+        (_, legacy_time, legacy_xml), (_, digest_time, digest_xml) = results
+        print(f"list items: {size}, same result: {legacy_xml == digest_xml}, legacy: {legacy_time * 1000:.1f}ms, "
+              f"digest: {digest_time * 1000:.1f}ms")
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    # 本地假服务端，按OpenAI接口格式返回固定的chat和embedding结果，并统计新建的TCP连接数
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    connections = 0
+    # 大于0时模拟服务端限流：每秒最多处理requests_per_second个请求，超出的返回429和Retry-After
+    requests_per_second = 0
+    throttled = 0
+    served = []
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        FakeLLMHandler.connections += 1
+
+    def throttle(self):
+        with FakeLLMHandler.lock:
+            now = time.monotonic()
+            FakeLLMHandler.served = [ts for ts in FakeLLMHandler.served if now - ts < 1.0]
+            if len(FakeLLMHandler.served) >= FakeLLMHandler.requests_per_second:
+                FakeLLMHandler.throttled += 1
+                return True
+            FakeLLMHandler.served.append(now)
+            return False
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if FakeLLMHandler.requests_per_second > 0 and self.throttle():
+            data = b'{"error": {"code": "429", "message": "rate limit exceeded"}}'
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if self.path.split('?')[0].endswith('/embeddings'):
+            body = {"object": "list", "model": request["model"],
+                    "data": [{"object": "embedding", "index": i, "embedding": [0.1, 0.2, 0.3]}
+                             for i in range(len(request["input"]))],
+                    "usage": {"prompt_tokens": len(request["input"]), "total_tokens": len(request["input"])}}
+        else:
+            body = {"id": "fake", "object": "chat.completion", "created": 0, "model": request["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": '{"element_semantic": "fake"}'}}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_llm_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = configparser.ConfigParser()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    config.read_dict({'gpt4': {'endpoint': url, 'gpt_key': 'fake', 'embedding_url': url + '/v1',
+                               'embedding_key': 'fake', 'embedding_model': 'fake-embedding'}})
+    return server, config
+
+
+def bench_llm(call_count):
+    # 对比每次调用都新建客户端（原来的做法）和共享客户端注册表的同步、异步调用，不访问网络
+    server, config = start_fake_llm_server()
+    kwargs = dict(model="gpt-4o-2024-05-13", messages=[{"role": "user", "content": "hello"}], max_tokens=16)
+
+    def per_call_client():
+        registry = LLMClientRegistry(config)
+        registry.chat(**kwargs)
+        registry.close()
+
+    shared = LLMClientRegistry(config)
+
+    async def async_calls():
+        await asyncio.gather(*[shared.achat(**kwargs) for _ in range(call_count)])
+        await shared.aclose()
+
+    cases = [("new client per call", lambda: [per_call_client() for _ in range(call_count)]),
+             ("shared client", lambda: [shared.chat(**kwargs) for _ in range(call_count)]),
+             ("shared async client", lambda: asyncio.run(async_calls())),
+             ("shared embedding", lambda: [shared.embed(["a", "b"]) for _ in range(call_count)])]
+    for name, run in cases:
+        FakeLLMHandler.connections = 0
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {call_count} calls, {elapsed * 1000:.1f}ms, {elapsed / call_count * 1000:.2f}ms/call, "
+              f"tcp connections: {FakeLLMHandler.connections}")
+    print(f"llm client: {shared.stats()}")
+    shared.close()
+    server.shutdown()
+    server.server_close()
+
+
+def legacy_retry_call(registry, kwargs):
+    # ask_gpt4o原来的重试：任何异常固定等待5秒，最多5次
+    for _ in range(5):
+        try:
+            return registry.chat(**kwargs)
+        except Exception:
+            time.sleep(5)
+
+
+def bench_schedule(call_count, workers=8):
+    # 假服务端每秒最多处理20个请求，8个线程并发调用，其中每4个调用有1个是执行阶段的高优先级调用；
+    # 调度器的RPM预算略高于服务端的实际限制，需要依靠429和Retry-After自适应降速
+    server, config = start_fake_llm_server()
+    FakeLLMHandler.requests_per_second = 20
+    kwargs = dict(model="gpt-4o-2024-05-13", messages=[{"role": "user", "content": "hello"}], max_tokens=16)
+    registry = LLMClientRegistry(config, max_retries=0)
+    scheduler = LLMScheduler(rpm=1500, base_delay=0.5)
+    cases = [("legacy fixed 5s retry", lambda i: legacy_retry_call(registry, kwargs)),
+             ("token bucket scheduler", lambda i: scheduler.call(
+                 lambda: registry.chat(**kwargs), 0, PRIORITY_EXECUTE if i % 4 == 0 else PRIORITY_SEMANTIC))]
+    for name, call in cases:
+        FakeLLMHandler.throttled = 0
+        FakeLLMHandler.served = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(call, range(call_count)))
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {call_count} calls, {elapsed:.2f}s, {call_count / elapsed:.1f} calls/s, "
+              f"429 responses: {FakeLLMHandler.throttled}")
+    print(f"llm scheduler: {scheduler.stats()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark SemanticAgent XML processing on recorded events")
+    parser.add_argument("path", help="droidbot output dir containing events/")
+    parser.add_argument("bench", choices=["hierarchy", "xpath", "tree", "parse", "reduce", "recycle", "llm", "schedule"])
+    parser.add_argument("--limit", type=int, default=0, help="max number of key events to load, 0 for all")
+    parser.add_argument("--sizes", default="100,500,2000", help="list item counts of the synthetic xpath screens")
+    args = parser.parse_args()
+    if args.bench == "hierarchy":
+        bench_hierarchy(load_xml_list(args.path, args.limit))
+    elif args.bench == "xpath":
+        bench_xpath([int(size) for size in args.sizes.split(',')])
+    elif args.bench == "tree":
+        xml_list = load_xml_list(args.path, args.limit) if args.path != '-' else []
+        bench_tree(xml_list, [int(size) for size in args.sizes.split(',')])
+    elif args.bench == "parse":
+        xml_list = load_xml_list(args.path, args.limit) if args.path != '-' else []
+        bench_parse(xml_list, [int(size) for size in args.sizes.split(',')])
+    elif args.bench == "reduce":
+        bench_reduce(load_xml_list(args.path, args.limit))
+    elif args.bench == "recycle":
+        bench_recycle([int(size) for size in args.sizes.split(',')])
+    elif args.bench == "llm":
+        bench_llm(args.limit or 200)
+    elif args.bench == "schedule":
+        bench_schedule(args.limit or 200)
@@ -0,0 +1,185 @@
+import copy
+import json
+import os
+import threading
+
+# 同一结构簇的代表事件在这些字段上一致时，才把结果分配给簇内其余事件
+CLUSTER_AGREEMENT_FIELDS = ["element_semantic", "previous_page_name", "current_page_name"]
+
+
+def transition_key(event_data):
+    """
+    事件的转移key：起始状态、动作类型、动作控件、到达状态都相同的事件语义相同
+    """
+    event_info = event_data['event']
+    return (event_data['start_state'], event_info['event_type'], event_info['view']['view_str'],
+            event_data['stop_state'])
+
+
+def reuse_gpt_out(event_data, gpt_out, source, reuse_type="transition"):
+    """
+    把代表事件的标注结果复制给重复事件，并记录来源
+    :param reuse_type: transition表示完全相同的转移，cluster表示同一结构簇
+    """
+    event_data["gpt_out"] = copy.deepcopy(gpt_out)
+    event_data["gpt_out"]["reused_from"] = source
+    event_data["gpt_out"]["reuse_type"] = reuse_type
+
+
+def load_structure_strs(path):
+    """
+    读取states目录，得到 state_str -> state_str_content_free(DeviceState.structure_str) 的映射
+    """
+    structure_strs = {}
+    states_path = os.path.join(path, 'states')
+    if not os.path.isdir(states_path):
+        return structure_strs
+    for state_file in os.listdir(states_path):
+        if not state_file.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(states_path, state_file), 'r') as f:
+                state = json.load(f)
+            structure_strs[state['state_str']] = state['state_str_content_free']
+        except Exception as e:
+            print(e, state_file)
+    return structure_strs
+
+
+def event_source(json_path, event_data):
+    # 复用结果的来源记录为最初被标注的事件文件名
+    return event_data.get("gpt_out", {}).get("reused_from", os.path.basename(json_path))
+
+
+class TransitionRegistry:
+    """
+    按转移key去重的标注登记表：同一个key只由一个线程调用LLM，其余重复事件等待并复用其结果，
+    代表事件标注失败时，由下一个等待的事件重新标注
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.in_flight = set()
+        self.reused = 0
+        self._cond = threading.Condition()
+
+    def claim(self, key):
+        """
+        :return: 已有结果时返回 (gpt_out, 来源事件)，否则登记为由当前线程标注并返回None
+        """
+        with self._cond:
+            while key in self.in_flight:
+                self._cond.wait()
+            if key in self.results:
+                self.reused += 1
+                return self.results[key]
+            self.in_flight.add(key)
+            return None
+
+    def complete(self, key, gpt_out, source):
+        with self._cond:
+            self.in_flight.discard(key)
+            self.results[key] = (gpt_out, source)
+            self._cond.notify_all()
+
+    def fail(self, key):
+        with self._cond:
+            self.in_flight.discard(key)
+            self._cond.notify_all()
+
+    def record(self, key, gpt_out, source):
+        # 之前已经标注过的事件，供后续的重复事件复用，不计入本次的LLM调用
+        with self._cond:
+            if key not in self.results:
+                self.results[key] = (gpt_out, source)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "transitions": len(self.results),
+                "reused": self.reused,
+            }
+
+
+class ClusterRegistry:
+    """
+    按结构簇的预算标注：起止页面的structure_str和动作控件的content_free_signature相同的事件属于同一簇，
+    每簇只标注k个代表事件，代表事件的结果一致时分配给簇内其余事件，不一致时该簇升级为逐个标注
+    """
+
+    def __init__(self, k, structure_strs):
+        self.k = k
+        self.structure_strs = structure_strs
+        self.clusters = {}
+        self.assigned = 0
+        self.escalated_calls = 0
+        self._cond = threading.Condition()
+
+    def cluster_key(self, event_data):
+        event_info = event_data['event']
+        view = event_info['view']
+        return (self.structure_strs.get(event_data['start_state'], event_data['start_state']),
+                event_info['event_type'],
+                view.get('content_free_signature', view.get('signature', view['view_str'])),
+                self.structure_strs.get(event_data['stop_state'], event_data['stop_state']))
+
+    @staticmethod
+    def agree(results):
+        def normalize(gpt_out):
+            return [str(gpt_out.get(field, "")).strip().lower() for field in CLUSTER_AGREEMENT_FIELDS]
+        first = normalize(results[0][0])
+        return all(normalize(gpt_out) == first for gpt_out, _ in results[1:])
+
+    def claim(self, key):
+        """
+        :return: ("annotate", True) 作为代表事件标注；("annotate", False) 簇已升级，单独标注；
+                 ("assign", (gpt_out, 来源事件)) 直接使用代表事件的结果
+        """
+        with self._cond:
+            cluster = self.clusters.setdefault(key, {"results": [], "in_flight": 0, "escalated": False})
+            while True:
+                if cluster["escalated"]:
+                    self.escalated_calls += 1
+                    return "annotate", False
+                if len(cluster["results"]) >= self.k:
+                    self.assigned += 1
+                    return "assign", cluster["results"][0]
+                if len(cluster["results"]) + cluster["in_flight"] < self.k:
+                    cluster["in_flight"] += 1
+                    return "annotate", True
+                # 代表事件还在标注中，等待结果
+                self._cond.wait()
+
+    def complete(self, key, gpt_out, source):
+        with self._cond:
+            cluster = self.clusters[key]
+            cluster["in_flight"] -= 1
+            cluster["results"].append((gpt_out, source))
+            if len(cluster["results"]) == self.k and not self.agree(cluster["results"]):
+                cluster["escalated"] = True
+                print(f"representatives of cluster {key} disagree, escalate to per-event annotation")
+            self._cond.notify_all()
+
+    def fail(self, key):
+        with self._cond:
+            self.clusters[key]["in_flight"] -= 1
+            self._cond.notify_all()
+
+    def record(self, key, gpt_out, source):
+        # 之前已经标注过的事件也作为代表事件
+        with self._cond:
+            cluster = self.clusters.setdefault(key, {"results": [], "in_flight": 0, "escalated": False})
+            if len(cluster["results"]) < self.k:
+                cluster["results"].append((gpt_out, source))
+                if len(cluster["results"]) == self.k and not self.agree(cluster["results"]):
+                    cluster["escalated"] = True
+
+    def stats(self):
+        with self._cond:
+            return {
+                "clusters": len(self.clusters),
+                "representatives": sum(len(cluster["results"]) for cluster in self.clusters.values()),
+                "assigned": self.assigned,
+                "escalated_clusters": sum(1 for cluster in self.clusters.values() if cluster["escalated"]),
+                "escalated_calls": self.escalated_calls,
+            }
@@ -143,6 +143,33 @@ USER_PROMPT_ENGLISH_V1 = """
 Your response must be in JSON format and in english, that carefully referenced "Format example".
 """
 
+USER_PROMPT_DIFF_ENGLISH_V1 = """
+# Action node information
+## Action type
+{action_type}
+## Action node information
+{action_node} 
+
+# Previous scene information:
+## Previous scene activity:
+{activity_start}
+## Previous scene fragment information:
+{fragment_start}
+## Previous scene reduced Page XML
+{xml_pre_reduced}
+
+# Current scene information:
+## Current scene activity:
+{activity_stop}
+## Current scene fragment information:
+{fragment_stop}
+## Current scene reduced Page XML, given as the changes from the previous scene
+Lines starting with "-" were removed, lines starting with "+" were added, lines starting with spaces are unchanged parent nodes for context. All other lines are the same as in the previous scene.
+{xml_diff}
+---
+Your response must be in JSON format and in english, that carefully referenced "Format example".
+"""
+
 example_scene = """
 
 """
@@ -1,14 +1,19 @@
 import datetime
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from natsort import natsorted
-import xml.etree.ElementTree as ET
 from colorama import Fore
-from xml_extract import UIXMLTree
-from tree_node import build_tree_from_xml
-from core.azure_gpt4 import ask_gpt4o
-from core.embedding import embeddings
-from core.graph_manager import GraphManager
+from ui_hierarchy import UIHierarchy, get_reduce_cache
+from xml_extract import diff_plain_text
+from semantic_pipeline import SemanticPipeline
+from event_grouping import TransitionRegistry, ClusterRegistry, transition_key, reuse_gpt_out, event_source, \
+    load_structure_strs
+from core.azure_gpt4 import ask_gpt4o, get_llm_cache, get_scheduler, estimate_tokens
+from core.embedding import embeddings, get_embedding_cache
+from core.llm_client import get_llm_client, load_config
+from core.graph_manager import create_graph_manager
 from agent_semantic.prompts.semantic_prompt import *
 
 figure_dict = {}
@@ -16,8 +21,27 @@ language = "english"
 
 
 class SemanticAgent:
-    def __init__(self):
-        pass
+    def __init__(self, workers=None):
+        config = load_config()
+        # 并发标注时同时在途的LLM请求数，1表示串行
+        self.workers = workers if workers is not None else config.getint('semantic', 'workers', fallback=1)
+        # 流水线模式下各阶段之间队列的容量
+        self.queue_size = config.getint('semantic', 'queue_size', fallback=32)
+        self.use_pipeline = config.getboolean('semantic', 'pipeline', fallback=False)
+        # full: 前后两个页面都完整发送；diff: 发送前一个页面和两个页面之间的变化
+        self.prompt_mode = config.get('semantic', 'prompt_mode', fallback='full')
+        self.prompt_tokens = {"full": 0, "sent": 0}
+        self.prompt_tokens_lock = threading.Lock()
+        # 相同转移(start_state, 动作, view_str, stop_state)的事件只标注一次，其余复用结果
+        self.reuse_duplicates = config.getboolean('semantic', 'reuse_duplicates', fallback=True)
+        # 忽略已有的gpt_out，重新标注所有事件
+        self.force_annotate = config.getboolean('semantic', 'force_annotate', fallback=False)
+        self.transitions = TransitionRegistry()
+        # 预算标注：每个结构簇只标注k个代表事件，0表示不启用
+        self.cluster_representatives = config.getint('semantic', 'cluster_representatives', fallback=0)
+        self.clusters = None
+        self.annotate_counts = {"llm_calls": 0, "covered": 0}
+        self.annotate_counts_lock = threading.Lock()
 
     def get_system_prompt(self, language, type):
         if language == "english":
@@ -26,46 +50,6 @@ class SemanticAgent:
             else:
                 return SYSTEM_PROMPT_SWIPE_ENGLISH_V1 + example_scene + example_swipe
 
-    def compress_xml_to_one_line(self, xml_text):
-        from xml.dom import minidom
-        # 解析 XML 字符串
-        root = ET.fromstring(xml_text)
-        # 将 ElementTree 转换为字符串
-        rough_string = ET.tostring(root, 'utf-8')
-        # 使用 minidom 进行格式化
-        reparsed = minidom.parseString(rough_string)
-        # 将格式化后的 XML 压缩成一行
-        one_line_xml = reparsed.toxml()
-        # 移除换行和多余空格
-        one_line_xml = "".join(line.strip() for line in one_line_xml.split("\n"))
-        return one_line_xml
-
-    def check_webKit(self, xml_data):
-        # 解析XML字符串
-        try:
-            root = ET.fromstring(xml_data)
-        except ET.ParseError:
-            return False
-        # 使用XPath查找所有具有特定 base-class 属性的节点
-        webview_nodes = root.findall(".//node[@base-class='android.webkit.WebView']")
-
-        # 检查是否找到了WebView
-        if webview_nodes:
-            print("找到含有 WebView 的 base-class 字段。")
-            return True
-        else:
-            return False
-
-    def select_target_root_node(self, xml):
-        exlude_package = ["com.android.systemui", "com.github.uiautomator"]
-        # iterate all the root nodes from the xml node, and select the one we want
-        root = ET.fromstring(xml)
-        for child in root:
-            if child.tag == "node" and child.get("package") in exlude_package:
-                continue
-            return ET.tostring(child, encoding='unicode')  # 或者使用 encoding='utf-8' 根据需要
-        return None
-
     def extract_text(self, filename):
         # 查找 "view_" 和 ".png" 的开始索引
         start_index = filename.find("view_")
@@ -87,7 +71,29 @@ class SemanticAgent:
                 view_name = self.extract_text(pic)
                 figure_dict[view_name] = os.path.join(views_path, pic)
 
-    def execute_description(self, event_data, event_info, json_path):
+    def build_user_prompt(self, action_type, action_node_info, activity_start, activity_stop, fragment_start,
+                          fragment_stop, xml_pre_reduced, xml_after_reduced):
+        prompt_args = dict(action_type=action_type, action_node=action_node_info, activity_start=activity_start,
+                           activity_stop=activity_stop, fragment_start=fragment_start, fragment_stop=fragment_stop,
+                           xml_pre_reduced=xml_pre_reduced)
+        user_prompt = USER_PROMPT_ENGLISH_V1.format(xml_after_reduced=xml_after_reduced, **prompt_args)
+        full_tokens = estimate_tokens(user_prompt)
+        sent_tokens = full_tokens
+        if self.prompt_mode == "diff":
+            diff_prompt = USER_PROMPT_DIFF_ENGLISH_V1.format(
+                xml_diff=diff_plain_text(xml_pre_reduced, xml_after_reduced), **prompt_args)
+            diff_tokens = estimate_tokens(diff_prompt)
+            print(f"prompt tokens: full {full_tokens}, diff {diff_tokens}")
+            # 页面整体切换时diff可能比完整页面更长，此时仍发送完整页面
+            if diff_tokens < full_tokens:
+                user_prompt = diff_prompt
+                sent_tokens = diff_tokens
+        with self.prompt_tokens_lock:
+            self.prompt_tokens["full"] += full_tokens
+            self.prompt_tokens["sent"] += sent_tokens
+        return user_prompt
+
+    def execute_description(self, event_data, event_info, json_path, save=True):
         view_hash = event_info['view']['view_str']
         figure_path = ""
         if view_hash in figure_dict:
@@ -104,43 +110,34 @@ class SemanticAgent:
         for key, value in action_node.items():
             if key in given_key:
                 action_node_info += f"{key}: {value}\n"
-        ui_xml_tree = UIXMLTree()
         xml_pre = event_data['start_xml']
         xml_after = event_data['stop_xml']
         try:
-            xml_pre_reduced = ui_xml_tree.process(self.select_target_root_node(xml_pre), app_name="AnkiDroid", level=1, str_type="plain_text", remove_system_bar=True, use_bounds=False, merge_switch=False)
-            xml_after_reduced = ui_xml_tree.process(self.select_target_root_node(xml_after), app_name="AnkiDroid", level=1, str_type="plain_text", remove_system_bar=True, use_bounds=False, merge_switch=False)
+            # 每个XML只解析一次，精简文本、activity/fragment和WebView检测共用同一份解析结果
+            hierarchy_pre = UIHierarchy(xml_pre)
+            hierarchy_after = UIHierarchy(xml_after)
+            xml_pre_reduced = hierarchy_pre.reduce(app_name="AnkiDroid", level=1, str_type="plain_text", remove_system_bar=True, use_bounds=False, merge_switch=False)
+            xml_after_reduced = hierarchy_after.reduce(app_name="AnkiDroid", level=1, str_type="plain_text", remove_system_bar=True, use_bounds=False, merge_switch=False)
         except Exception as e:
             print(e, json_path)
             return -1
-        # xml_pre_reduced = UIState(UITree(self.compress_xml_to_one_line(xml_pre), is_json=False)).to_xml()
-        # xml_after_reduced = UIState(UITree(self.compress_xml_to_one_line(xml_after), is_json=False)).to_xml()
 
-        tree_start = build_tree_from_xml(xml_pre)
-        tree_stop = build_tree_from_xml(xml_after)
-        activity_start = tree_start.get_activity_list()
-        activity_stop = tree_stop.get_activity_list()
-        fragment_start = tree_start.get_fragment_list()
-        fragment_stop = tree_stop.get_fragment_list()
+        activity_start = hierarchy_pre.get_activity_list()
+        activity_stop = hierarchy_after.get_activity_list()
+        fragment_start = hierarchy_pre.get_fragment_list()
+        fragment_stop = hierarchy_after.get_fragment_list()
 
         # check webview, if so, use ocr
         ocr_string_list_pre, ocr_string_list_after = [], []
-        webview_flag_pre, webview_flag_after = self.check_webKit(xml_pre), self.check_webKit(xml_after)
+        webview_flag_pre, webview_flag_after = hierarchy_pre.has_webview(), hierarchy_after.has_webview()
         if webview_flag_pre:  # 检查是否为webview界面
             print("page is webview, execute OCR")
         if webview_flag_after:
             print("page is webview, execute OCR")
         # if webview_flag_pre:
         #     ocr_string_list_pre = self.ocr_webview(tree_start)
-        user_prompt = USER_PROMPT_ENGLISH_V1.format(action_type=action_type,
-                                                    action_node=action_node_info,
-                                                    activity_start=activity_start,
-                                                    activity_stop=activity_stop,
-                                                    fragment_start=fragment_start,
-                                                    fragment_stop=fragment_stop,
-                                                    xml_pre_reduced=xml_pre_reduced,
-                                                    xml_after_reduced=xml_after_reduced,
-                                                    )
+        user_prompt = self.build_user_prompt(action_type, action_node_info, activity_start, activity_stop,
+                                             fragment_start, fragment_stop, xml_pre_reduced, xml_after_reduced)
         # print(user_prompt)
         if action_type == 'CLICK' or action_type == 'LONG_CLICK':
             system_prompt = self.get_system_prompt(language, type="click")
@@ -149,7 +146,8 @@ class SemanticAgent:
 
         # gpt_out = ask_gpt4_1106(system_prompt, user_prompt, need_json=True, language=language)
         gpt_out = ask_gpt4o(system_prompt, user_prompt, [figure_path])
-        if gpt_out is None:
+        if not isinstance(gpt_out, dict):
+            print(gpt_out, json_path)
             return -1
         print(gpt_out)
         print(Fore.CYAN + "action_name:", gpt_out['action_name'])
@@ -169,27 +167,208 @@ class SemanticAgent:
             "current_page_name": gpt_out.get("current_page_name", ""),
             "current_page_description": gpt_out.get("current_page_description", ""),
         }
-        with open(json_path, 'w', encoding='utf-8') as file:
-            json.dump(event_data, file, ensure_ascii=False, indent=4)
+        if save:
+            with open(json_path, 'w', encoding='utf-8') as file:
+                json.dump(event_data, file, ensure_ascii=False, indent=4)
         return 0
 
-    def execute_embedding(self, event_data, json_path):
+    def get_embedding_words(self, event_data):
         gpt_out = event_data['gpt_out']
-        word_list = [gpt_out['action_name'], gpt_out['element_semantic'], gpt_out['previous_page_name'], gpt_out['current_page_name']]
-        embedding_list = embeddings(word_list)
+        return [gpt_out['action_name'], gpt_out['element_semantic'], gpt_out['previous_page_name'], gpt_out['current_page_name']]
+
+    def set_embedding(self, event_data, embedding_list):
         event_data["embedding"] = {
             "action_name_embedding": embedding_list[0],
             "element_semantic_embedding": embedding_list[1],
             "previous_page_name_embedding": embedding_list[2],
             "current_page_name_embedding": embedding_list[3],
         }
-        with open(json_path, 'w', encoding='utf-8') as file:
-            json.dump(event_data, file, ensure_ascii=False, indent=4)
-        return 0
+
+    def execute_embedding_batch(self, path):
+        """
+        收集整个events目录中所有待向量化的文本，去重后批量请求，再把向量写回各个事件
+        """
+        events_path = os.path.join(path, 'events')
+        event_words = []
+        for event in natsorted(os.listdir(events_path)):
+            if not event.endswith('.json'):
+                continue
+            json_path = os.path.join(events_path, event)
+            with open(json_path, 'r') as f:
+                try:
+                    event_data = json.load(f)
+                except Exception as e:
+                    print(e, json_path)
+                    continue
+            if "gpt_out" not in event_data or "view" not in event_data['event']:
+                continue
+            event_words.append((json_path, self.get_embedding_words(event_data)))
+        all_words = [word for _, words in event_words for word in words]
+        distinct_words = list(dict.fromkeys(all_words))
+        print(f"embedding texts: {len(all_words)}, distinct: {len(distinct_words)}")
+        word_to_vector = dict(zip(distinct_words, embeddings(distinct_words)))
+
+        index = 0
+        for json_path, words in event_words:
+            with open(json_path, 'r') as f:
+                event_data = json.load(f)
+            self.set_embedding(event_data, [word_to_vector[word] for word in words])
+            with open(json_path, 'w', encoding='utf-8') as file:
+                json.dump(event_data, file, ensure_ascii=False, indent=4)
+            index += 1
+        embedding_cache = get_embedding_cache()
+        if embedding_cache is not None:
+            print(f"embedding cache: {embedding_cache.stats()}")
+        return index
+
+    def build_node_info(self, event_data):
+        event_info = event_data['event']
+        return {
+            "start_state": {
+                "hash_id": event_data['start_state'],
+                "name": event_data['gpt_out']['previous_page_name'],
+                "description": event_data['gpt_out']['previous_page_description'],
+            },
+            "action_state": {
+                "hash_id": event_info['view']['view_str'],
+                "name": event_data['gpt_out']['action_name'],
+                "element_semantic": event_data['gpt_out']['element_semantic'],
+                "description": event_data['gpt_out']['action_description'],
+                "bounds": event_info['view']['bounds'],
+                "resource_id": event_info['view']['resource_id'],
+                "event_type": event_info['event_type'],
+                "class": event_info['view']['class'],
+            },
+            "stop_state": {
+                "hash_id": event_data['stop_state'],
+                "name": event_data['gpt_out']['current_page_name'],
+                "description": event_data['gpt_out']['current_page_description'],
+            }
+        }
+
+    def execute_description_safe(self, event_data, event_info, json_path, save=True):
+        try:
+            return self.execute_description(event_data, event_info, json_path, save)
+        except Exception as e:
+            print(Fore.RED + f"execute_description Exception: {e}, {json_path}" + Fore.RESET)
+            return -1
+
+    def reset_annotate_state(self, path):
+        self.transitions = TransitionRegistry()
+        self.clusters = None
+        if self.cluster_representatives > 0:
+            self.clusters = ClusterRegistry(self.cluster_representatives, load_structure_strs(path))
+        self.annotate_counts = {"llm_calls": 0, "covered": 0}
+
+    def print_annotate_stats(self):
+        llm_calls, covered = self.annotate_counts["llm_calls"], self.annotate_counts["covered"]
+        per_call = covered / llm_calls if llm_calls else 0.0
+        print(f"annotation: {llm_calls} llm calls covered {covered} events, {per_call:.2f} events per call")
+        if self.reuse_duplicates:
+            print(f"transition reuse: {self.transitions.stats()}")
+        if self.clusters is not None:
+            print(f"cluster annotation: {self.clusters.stats()}")
+
+    def print_run_stats(self):
+        """
+        语义标注结束后的统计，逐事件执行和流水线执行共用
+        """
+        llm_cache = get_llm_cache()
+        if llm_cache is not None:
+            print(f"llm cache: {llm_cache.stats()}")
+        print(f"llm client: {get_llm_client().stats()}")
+        print(f"llm scheduler: {get_scheduler().stats()}")
+        reduce_cache = get_reduce_cache()
+        if reduce_cache is not None:
+            print(f"reduce cache: {reduce_cache.stats()}")
+        print(f"estimated prompt tokens ({self.prompt_mode} mode): {self.prompt_tokens}")
+        self.print_annotate_stats()
+
+    def need_annotate(self, event_data, json_path):
+        if "gpt_out" in event_data and not self.force_annotate:
+            # 已标注的事件可供后续相同转移或相同结构簇的事件复用
+            if "view" in event_data['event']:
+                source = event_source(json_path, event_data)
+                if self.reuse_duplicates:
+                    self.transitions.record(transition_key(event_data), event_data["gpt_out"], source)
+                if self.clusters is not None and "reused_from" not in event_data["gpt_out"]:
+                    self.clusters.record(self.clusters.cluster_key(event_data), event_data["gpt_out"], source)
+            return False
+        return True
+
+    def annotate_event(self, event_data, event_info, json_path, save=True):
+        """
+        标注一个关键事件：相同转移的事件只调用一次LLM，开启结构簇预算标注时同一簇只标注k个代表事件，
+        其余事件复制代表事件的结果
+        """
+        key = transition_key(event_data)
+        reused = self.transitions.claim(key) if self.reuse_duplicates else None
+        if reused is not None:
+            reuse_gpt_out(event_data, *reused)
+            res = 0
+        elif self.clusters is not None:
+            res = self.annotate_in_cluster(event_data, event_info, json_path)
+        else:
+            res = self.execute_description_counted(event_data, event_info, json_path)
+        if self.reuse_duplicates and reused is None:
+            if res == -1:
+                self.transitions.fail(key)
+            else:
+                self.transitions.complete(key, event_data["gpt_out"], event_source(json_path, event_data))
+        if res != -1:
+            with self.annotate_counts_lock:
+                self.annotate_counts["covered"] += 1
+            if "reused_from" in event_data["gpt_out"]:
+                print(f"reuse semantic of {event_data['gpt_out']['reused_from']} for {json_path}")
+            if save:
+                with open(json_path, 'w', encoding='utf-8') as file:
+                    json.dump(event_data, file, ensure_ascii=False, indent=4)
+        return res
+
+    def annotate_in_cluster(self, event_data, event_info, json_path):
+        cluster_key = self.clusters.cluster_key(event_data)
+        action, value = self.clusters.claim(cluster_key)
+        if action == "assign":
+            reuse_gpt_out(event_data, *value, reuse_type="cluster")
+            return 0
+        res = self.execute_description_counted(event_data, event_info, json_path)
+        # value为True表示当前事件是簇的代表事件
+        if value:
+            if res == -1:
+                self.clusters.fail(cluster_key)
+            else:
+                self.clusters.complete(cluster_key, event_data["gpt_out"], os.path.basename(json_path))
+        return res
+
+    def execute_description_counted(self, event_data, event_info, json_path):
+        with self.annotate_counts_lock:
+            self.annotate_counts["llm_calls"] += 1
+        # 由annotate_event统一写回文件
+        return self.execute_description_safe(event_data, event_info, json_path, save=False)
+
+    def run_pipeline(self, path, graph_name):
+        """
+        语义标注、向量化、构图三个阶段流水线执行，每个事件文件只读写一次
+        """
+        self.reset_annotate_state(path)
+        pipeline = SemanticPipeline(self, path, graph_name, queue_size=self.queue_size)
+        return pipeline.run()
 
     def load_dir_and_execute(self, path, method, graph_name=""):
+        if method == "embedding":
+            index = self.execute_embedding_batch(path)
+            print(f"index: {index}")
+            return
         index, error_num = 0, 0
         events_path = os.path.join(path, 'events')
+        # 并发标注：最多同时保留workers个请求在途，结果完成后即由execute_description写回文件
+        executor = ThreadPoolExecutor(max_workers=self.workers) if method == "semantic" and self.workers > 1 else None
+        pending = set()
+        # 构图时只建立一次连接，所有事件收集完后批量写入
+        graph_manager = create_graph_manager(graph_name) if method == "build_graph" else None
+        node_info_list = []
+        if method == "semantic":
+            self.reset_annotate_state(path)
         for event in natsorted(os.listdir(events_path)):
             if event.endswith('.json'):
                 json_path = os.path.join(events_path, event)
@@ -203,53 +382,41 @@ class SemanticAgent:
                     event_info = event_data['event']
                 # get semantic for each scene and action
                 if method == "semantic":
-                    if "gpt_out" in event_data:
+                    if not self.need_annotate(event_data, json_path):
                         continue
                     if "view" in event_info:  # means it is a key event
-                        res = self.execute_description(event_data, event_info, json_path)
+                        if executor is not None:
+                            if len(pending) >= self.workers:
+                                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                for future in done:
+                                    if future.result() == -1:
+                                        error_num += 1
+                                    else:
+                                        index += 1
+                            pending.add(executor.submit(self.annotate_event, event_data, event_info, json_path))
+                            continue
+                        res = self.annotate_event(event_data, event_info, json_path)
                         if res == -1:
                             error_num += 1
                         else:
                             index += 1
-                # get embedding for each semantic result
-                elif method == "embedding":
-                    if "gpt_out" not in event_data or "view" not in event_info:
-                        continue
-                    res = self.execute_embedding(event_data, json_path)
-                    if res == -1:
-                        error_num += 1
-                    else:
-                        index += 1
-                    print(index)
                 # build a graph using neo4j
                 elif method == "build_graph":
-                    graph_manager = GraphManager(graph_name)
                     if "gpt_out" not in event_data or "embedding" not in event_data or "view" not in event_info:
                         continue
-                    node_info = {
-                        "start_state": {
-                            "hash_id": event_data['start_state'],
-                            "name": event_data['gpt_out']['previous_page_name'],
-                            "description": event_data['gpt_out']['previous_page_description'],
-                        },
-                        "action_state": {
-                            "hash_id": event_info['view']['view_str'],
-                            "name": event_data['gpt_out']['action_name'],
-                            "element_semantic": event_data['gpt_out']['element_semantic'],
-                            "description": event_data['gpt_out']['action_description'],
-                            "bounds": event_info['view']['bounds'],
-                            "resource_id": event_info['view']['resource_id'],
-                            "event_type": event_info['event_type'],
-                            "class": event_info['view']['class'],
-                        },
-                        "stop_state": {
-                            "hash_id": event_data['stop_state'],
-                            "name": event_data['gpt_out']['current_page_name'],
-                            "description": event_data['gpt_out']['current_page_description'],
-                        }
-                    }
-                    graph_manager.build_graph_node(node_info)
-        print(f"index: {index}")
+                    node_info_list.append(self.build_node_info(event_data))
+        if graph_manager is not None:
+            index = graph_manager.build_graph_nodes(node_info_list)
+        if executor is not None:
+            for future in wait(pending).done:
+                if future.result() == -1:
+                    error_num += 1
+                else:
+                    index += 1
+            executor.shutdown()
+        print(f"index: {index}, error: {error_num}")
+        if method == "semantic":
+            self.print_run_stats()
 
 
 if __name__ == '__main__':
@@ -257,6 +424,9 @@ if __name__ == '__main__':
     semantic_agent = SemanticAgent()
     root_path = "/resources/output-anki"
     semantic_agent.load_figure(root_path)
-    semantic_agent.load_dir_and_execute(root_path, "semantic")
-    semantic_agent.load_dir_and_execute(root_path, "embedding")
-    semantic_agent.load_dir_and_execute(root_path, "build_graph", "anki")
+    if semantic_agent.use_pipeline:
+        semantic_agent.run_pipeline(root_path, "anki")
+    else:
+        semantic_agent.load_dir_and_execute(root_path, "semantic")
+        semantic_agent.load_dir_and_execute(root_path, "embedding")
+        semantic_agent.load_dir_and_execute(root_path, "build_graph", "anki")
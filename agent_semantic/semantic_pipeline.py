@@ -0,0 +1,270 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from natsort import natsorted
+from colorama import Fore
+from core.embedding import embeddings
+from core.graph_manager import create_graph_manager
+
+_STOP = object()
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.start_time = None
+        self.end_time = None
+        # 导致阶段线程退出的异常
+        self.failure = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+
+    def finish(self):
+        with self._lock:
+            self.end_time = time.time()
+
+    def record(self, busy_time, processed=1, errors=0):
+        with self._lock:
+            self.busy_time += busy_time
+            self.processed += processed
+            self.errors += errors
+
+    def fail(self, e):
+        with self._lock:
+            self.errors += 1
+            self.failure = e
+
+    def report(self):
+        elapsed = (self.end_time or time.time()) - (self.start_time or time.time())
+        throughput = self.processed / elapsed if elapsed > 0 else 0.0
+        report = f"{self.name}: processed {self.processed}, errors {self.errors}, {throughput:.2f} events/s, busy {self.busy_time:.1f}s"
+        if self.failure is not None:
+            report += f", failed: {self.failure!r}"
+        return report
+
+
+class MonitoredQueue(queue.Queue):
+    """
+    记录队列深度的有界队列，用于观察流水线的瓶颈阶段
+    """
+
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.samples = 0
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        with self.mutex:
+            depth = self._qsize()
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_sum += depth
+            self.samples += 1
+
+    def report(self):
+        avg_depth = self.depth_sum / self.samples if self.samples else 0.0
+        return f"queue {self.name}: size {self.maxsize}, max depth {self.max_depth}, avg depth {avg_depth:.1f}"
+
+
+class SemanticPipeline:
+    """
+    单遍流式处理：每个事件只读取一次，依次经过 语义标注 -> 向量化 -> 构图 三个阶段，
+    阶段之间用有界队列连接，三个阶段可以同时进行，事件JSON最多写回一次
+    """
+
+    def __init__(self, agent, path, graph_name, queue_size=32, embedding_batch_size=64):
+        self.agent = agent
+        self.path = path
+        self.graph_name = graph_name
+        self.embedding_batch_size = embedding_batch_size
+        self.annotate_queue = MonitoredQueue("annotate", queue_size)
+        self.embed_queue = MonitoredQueue("embedding", queue_size)
+        self.graph_queue = MonitoredQueue("build_graph", queue_size)
+        self.stats = {name: StageStats(name) for name in ["read", "semantic", "embedding", "build_graph"]}
+        self._annotate_workers_left = agent.workers
+        self._annotate_lock = threading.Lock()
+
+    def _fail(self, stats, e):
+        # 阶段线程因未捕获的异常退出，记为一次错误，run()结束后据此报告失败
+        traceback.print_exc()
+        print(Fore.RED + f"{stats.name} stage failed: {e}" + Fore.RESET)
+        stats.fail(e)
+
+    def _drain(self, input_queue):
+        # 失败的阶段继续消费上游的输入直到收到_STOP，避免上游阻塞在有界队列的put()上
+        while input_queue.get() is not _STOP:
+            pass
+
+    def read_stage(self):
+        stats = self.stats["read"]
+        stats.start()
+        try:
+            events_path = os.path.join(self.path, 'events')
+            for event in natsorted(os.listdir(events_path)):
+                if not event.endswith('.json'):
+                    continue
+                json_path = os.path.join(events_path, event)
+                start = time.time()
+                with open(json_path, 'r') as f:
+                    try:
+                        # Some event files are empty, filter them out
+                        event_data = json.load(f)
+                    except Exception as e:
+                        print(e, json_path)
+                        stats.record(time.time() - start, processed=0, errors=1)
+                        continue
+                stats.record(time.time() - start)
+                if "view" not in event_data['event']:
+                    continue
+                self.annotate_queue.put((json_path, event_data))
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            for _ in range(self.agent.workers):
+                self.annotate_queue.put(_STOP)
+            stats.finish()
+
+    def annotate_stage(self):
+        stats = self.stats["semantic"]
+        stats.start()
+        stopped = False
+        try:
+            while True:
+                item = self.annotate_queue.get()
+                if item is _STOP:
+                    stopped = True
+                    break
+                json_path, event_data = item
+                if not self.agent.need_annotate(event_data, json_path):
+                    self.embed_queue.put((json_path, event_data, False))
+                    continue
+                start = time.time()
+                res = self.agent.annotate_event(event_data, event_data['event'], json_path, save=False)
+                if res == -1:
+                    stats.record(time.time() - start, processed=0, errors=1)
+                else:
+                    stats.record(time.time() - start)
+                    self.embed_queue.put((json_path, event_data, True))
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            if not stopped:
+                self._drain(self.annotate_queue)
+            # 最后一个退出的标注线程通知下游结束
+            with self._annotate_lock:
+                self._annotate_workers_left -= 1
+                if self._annotate_workers_left == 0:
+                    stats.finish()
+                    self.embed_queue.put(_STOP)
+
+    def embedding_stage(self):
+        stats = self.stats["embedding"]
+        stats.start()
+        finished = False
+        try:
+            while not finished:
+                batch = [self.embed_queue.get()]
+                # 取出队列中已就绪的事件凑成一批，一次请求完成向量化
+                while len(batch) < self.embedding_batch_size and batch[-1] is not _STOP:
+                    try:
+                        batch.append(self.embed_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _STOP:
+                    finished = True
+                    batch.pop()
+                # 新标注的事件或尚无向量的事件需要向量化
+                todo = [(json_path, event_data) for json_path, event_data, annotated in batch
+                        if annotated or "embedding" not in event_data]
+                start = time.time()
+                embedded, failed = set(), set()
+                if todo:
+                    words = [word for _, event_data in todo for word in self.agent.get_embedding_words(event_data)]
+                    try:
+                        vectors = embeddings(words)
+                        for i, (json_path, event_data) in enumerate(todo):
+                            self.agent.set_embedding(event_data, vectors[i * 4:(i + 1) * 4])
+                            embedded.add(json_path)
+                    except Exception as e:
+                        print(Fore.RED + f"embedding Exception: {e}" + Fore.RESET)
+                        failed = {json_path for json_path, _ in todo}
+                for json_path, event_data, annotated in batch:
+                    # 标注或向量有更新时才写回文件，每个事件最多写一次
+                    if annotated or json_path in embedded:
+                        with open(json_path, 'w', encoding='utf-8') as file:
+                            json.dump(event_data, file, ensure_ascii=False, indent=4)
+                    if json_path not in failed:
+                        self.graph_queue.put(event_data)
+                stats.record(time.time() - start, processed=len(batch) - len(failed), errors=len(failed))
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            if not finished:
+                self._drain(self.embed_queue)
+            self.graph_queue.put(_STOP)
+            stats.finish()
+
+    def graph_stage(self, graph_manager):
+        stats = self.stats["build_graph"]
+        stats.start()
+        finished = False
+        try:
+            while not finished:
+                batch = [self.graph_queue.get()]
+                while len(batch) < graph_manager.batch_size and batch[-1] is not _STOP:
+                    try:
+                        batch.append(self.graph_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _STOP:
+                    finished = True
+                    batch.pop()
+                if not batch:
+                    continue
+                start = time.time()
+                try:
+                    graph_manager.build_graph_nodes([self.agent.build_node_info(event_data) for event_data in batch])
+                    stats.record(time.time() - start, processed=len(batch))
+                except Exception as e:
+                    print(Fore.RED + f"build_graph Exception: {e}" + Fore.RESET)
+                    stats.record(time.time() - start, processed=0, errors=len(batch))
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            if not finished:
+                self._drain(self.graph_queue)
+            stats.finish()
+
+    def run(self):
+        graph_manager = create_graph_manager(self.graph_name)
+        threads = [threading.Thread(target=self.read_stage, name="read")]
+        threads += [threading.Thread(target=self.annotate_stage, name=f"semantic-{i}") for i in range(self.agent.workers)]
+        threads.append(threading.Thread(target=self.embedding_stage, name="embedding"))
+        threads.append(threading.Thread(target=self.graph_stage, args=(graph_manager,), name="build_graph"))
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"pipeline finished in {time.time() - start:.1f}s")
+        for stats in self.stats.values():
+            print(stats.report())
+        for q in [self.annotate_queue, self.embed_queue, self.graph_queue]:
+            print(q.report())
+        self.agent.print_run_stats()
+        failed = [stats.name for stats in self.stats.values() if stats.failure is not None]
+        if failed:
+            raise RuntimeError(f"pipeline stages failed: {', '.join(failed)}")
+        return self.stats
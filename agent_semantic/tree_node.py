@@ -1,8 +1,12 @@
-import xmltodict
 import re
+from xml.parsers import expat
+from lxml import etree
 from enum import Enum
 
 
+EMPTY_SET = frozenset()
+
+
 class ActionType(Enum):
     ACTION_UNKNOWN = 0
     CRASH = 1
@@ -39,6 +43,15 @@ class ActionType(Enum):
 
 
 class TreeNode:
+    __slots__ = ("bounds", "resource_id", "class_name", "base_class_name", "text", "content_desc", "hint",
+                 "view_hash", "alpha", "tag", "page_xml", "page_fragment", "clickable", "long_clickable",
+                 "scrollable", "enable", "checkable", "editable", "selected", "scroll_type", "scroll_direction",
+                 "important_for_a11y", "activity_name", "elem_id", "parent", "children", "short_resource_id",
+                 "short_class_name", "short_base_class_name",
+                 # 子树聚合信息，由compute_subtree_info自底向上计算，add_child后失效
+                 "subtree_info_valid", "descendant_clickable", "subtree_selected", "subtree_fragments",
+                 "subtree_activities", "subtree_layouts")
+
     def __init__(self, node, parent=None):
         self.bounds = None
         if "@bounds" in node:
@@ -89,6 +102,13 @@ class TreeNode:
         if "." in self.base_class_name:
             self.short_base_class_name = self.base_class_name.split(".")[-1]
 
+        self.subtree_info_valid = False
+        self.descendant_clickable = False
+        self.subtree_selected = False
+        self.subtree_fragments = EMPTY_SET
+        self.subtree_activities = EMPTY_SET
+        self.subtree_layouts = EMPTY_SET
+
     def __str__(self):
         return "[resource-id:{}][class:{}][text:{}][content-desc:{}]{}[chidren-num:{}]".format(self.resource_id,
                                                                                                self.class_name,
@@ -111,6 +131,42 @@ class TreeNode:
 
     def add_child(self, node):
         self.children.append(node)
+        # 当前节点及已计算过聚合信息的祖先节点都需要重新计算
+        parent = self
+        while parent is not None and parent.subtree_info_valid:
+            parent.subtree_info_valid = False
+            parent = parent.parent
+
+    def compute_subtree_info(self):
+        """
+        自底向上计算整棵子树的聚合信息：是否有可点击的后代、子树中是否有选中节点，以及fragment/activity/layout集合
+        """
+        # 广度优先序列逆序遍历，保证子节点先于父节点计算
+        for node in reversed(self.get_all_nodes()):
+            if node.subtree_info_valid:
+                continue
+            descendant_clickable = False
+            subtree_selected = node.selected
+            fragments = {node.page_fragment} if node.page_fragment != "" else set()
+            activities = {node.activity_name} if node.activity_name != "" else set()
+            layouts = {node.page_xml} if node.page_xml != "" else set()
+            for child in node.children:
+                descendant_clickable = descendant_clickable or child.clickable or child.descendant_clickable
+                subtree_selected = subtree_selected or child.subtree_selected
+                fragments.update(child.subtree_fragments)
+                activities.update(child.subtree_activities)
+                layouts.update(child.subtree_layouts)
+            node.descendant_clickable = descendant_clickable
+            node.subtree_selected = subtree_selected
+            # 空集合共用同一个对象，减少大树上的内存占用
+            node.subtree_fragments = frozenset(fragments) if fragments else EMPTY_SET
+            node.subtree_activities = frozenset(activities) if activities else EMPTY_SET
+            node.subtree_layouts = frozenset(layouts) if layouts else EMPTY_SET
+            node.subtree_info_valid = True
+
+    def ensure_subtree_info(self):
+        if not self.subtree_info_valid:
+            self.compute_subtree_info()
 
     def dump(self, idx=0, clickable=False, long_clickable=False, scrollable=False, enable=False):
         print_self = True
@@ -206,11 +262,9 @@ class TreeNode:
         if self.clickable or self.checkable:
             return True
         if self.tag != "" or self.content_desc != "" or self.text != "":
-            all_nodes = self.get_all_nodes()
-            for node in all_nodes:
-                if node.clickable:
-                    return False
-            return True
+            # 有文本的节点，只有在后代都不可点击时才视为可点击
+            self.ensure_subtree_info()
+            return not self.descendant_clickable
         return False
 
     def is_long_clickable(self):
@@ -228,10 +282,8 @@ class TreeNode:
     def is_selected(self):
         if self.selected:
             return True
-        for node in self.get_all_nodes():
-            if node.selected:
-                return True
-        return False
+        self.ensure_subtree_info()
+        return self.subtree_selected
 
     def is_have_text(self):
         return self.text is not None
@@ -321,21 +373,17 @@ class TreeNode:
         return key_info
 
     def get_all_nodes(self):
+        # 广度优先，node_list本身作为队列，避免pop(0)
         node_list = [self]
-        queue = [self]
-        while len(queue) > 0:
-            node = queue.pop(0)
-            node_list += node.children
-            queue += node.children
+        i = 0
+        while i < len(node_list):
+            node_list += node_list[i].children
+            i += 1
         return node_list
 
     def get_fragment_list(self):
-        result = []
-        if self.page_fragment != "":
-            result.append(self.page_fragment)
-        for child in self.children:
-            result += child.get_fragment_list()
-        return list(set(result))
+        self.ensure_subtree_info()
+        return list(self.subtree_fragments)
 
     def get_fragment_dict(self):
         # 初始化一个空字典来存储结果
@@ -358,20 +406,12 @@ class TreeNode:
         return result
 
     def get_layout_list(self):
-        result = []
-        if self.page_xml != "":
-            result.append(self.page_xml)
-        for child in self.children:
-            result += child.get_layout_list()
-        return list(set(result))
+        self.ensure_subtree_info()
+        return list(self.subtree_layouts)
 
     def get_activity_list(self):
-        result = []
-        if self.activity_name != "":
-            result.append(self.activity_name)
-        for child in self.children:
-            result += child.get_activity_list()
-        return list(set(result))
+        self.ensure_subtree_info()
+        return list(self.subtree_activities)
 
 
 def is_same_node(node1, node2):
@@ -389,10 +429,72 @@ def get_flat_bounds(bounds):
     return bounds
 
 
+class TreeNodeBuilder:
+    """
+    解析器target接口(start/end/close)：按解析事件直接构建TreeNode，使用显式栈，
+    不生成中间字典，也不受递归深度限制。只处理node、lynx-root、lynx-node元素，其他元素连同其子树一起忽略
+    """
+    CHILD_TAGS = {"node": 0, "lynx-root": 1, "lynx-node": 2}
+
+    def __init__(self):
+        self.root = None
+        self.error = None
+        # 栈中每一项为 (TreeNode, 子节点的tag列表)
+        self.stack = []
+        self.skip_depth = 0
+
+    def start(self, tag, attrib):
+        if self.skip_depth > 0 or self.error is not None:
+            self.skip_depth += 1
+            return
+        if self.root is None and not self.stack:
+            if tag != "node":
+                self.error = "root tag is {}".format(tag)
+                self.skip_depth += 1
+                return
+        elif tag not in self.CHILD_TAGS:
+            self.skip_depth += 1
+            return
+        parent = self.stack[-1][0] if self.stack else None
+        tree_node = TreeNode({"@" + key: value for key, value in attrib.items()}, parent)
+        if parent is not None:
+            self.stack[-1][1].append(tag)
+        self.stack.append((tree_node, []))
+
+    def end(self, tag):
+        if self.skip_depth > 0:
+            self.skip_depth -= 1
+            return
+        tree_node, child_tags = self.stack.pop()
+        # 与原来的字典解析保持一致：子节点按node、lynx-root、lynx-node分组，组内保持文档顺序
+        if len(set(child_tags)) > 1:
+            order = sorted(range(len(child_tags)), key=lambda i: self.CHILD_TAGS[child_tags[i]])
+            tree_node.children = [tree_node.children[i] for i in order]
+        if self.stack:
+            self.stack[-1][0].add_child(tree_node)
+        else:
+            self.root = tree_node
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        if self.error is not None:
+            raise ValueError(self.error)
+        if self.root is None:
+            raise ValueError("no node element in xml")
+        self.root.compute_subtree_info()
+        return self.root
+
+
 def build_tree_from_xml(xml):
+    builder = TreeNodeBuilder()
+    parser = expat.ParserCreate("utf-8")
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
     try:
-        root = xmltodict.parse(xml, encoding="utf-8")
-        tree_node = parse_xml(root['node'])
+        parser.Parse(xml.encode("utf-8") if isinstance(xml, str) else xml, True)
+        tree_node = builder.close()
     except Exception as e:
         print("parse xml error, error={}".format(e))
         return None
@@ -400,30 +502,18 @@ def build_tree_from_xml(xml):
     return tree_node
 
 
-def parse_xml(root, parent=None):
-    tree_node = TreeNode(root, parent)
-    if "node" not in root and "lynx-root" not in root and "lynx-node" not in root:
-        return tree_node
-    if "node" in root:
-        node = root["node"]
-        deal_node(node, tree_node)
-    if "lynx-root" in root:
-        node = root["lynx-root"]
-        deal_node(node, tree_node)
-    if "lynx-node" in root:
-        node = root["lynx-node"]
-        deal_node(node, tree_node)
-
-    return tree_node
-
-
-def deal_node(node, tree_node):
-    if isinstance(node, dict):
-        child_node = parse_xml(node, tree_node)
-        child_node.parent = tree_node
-        tree_node.add_child(child_node)
-    elif isinstance(node, list):
-        for child in node:
-            child_node = parse_xml(child, tree_node)
-            child_node.parent = tree_node
-            tree_node.add_child(child_node)
+def build_tree_from_element(element):
+    """
+    从已解析的lxml元素构建TreeNode树，结果与build_tree_from_xml一致，不需要再次解析XML
+    """
+    builder = TreeNodeBuilder()
+    for event, child in etree.iterwalk(element, events=("start", "end")):
+        if event == "start":
+            builder.start(child.tag, child.attrib)
+        else:
+            builder.end(child.tag)
+    try:
+        return builder.close()
+    except ValueError as e:
+        print("parse xml error, error={}".format(e))
+        return None
@@ -0,0 +1,159 @@
+import copy
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from lxml import etree
+from xml_extract import UIXMLTree
+from tree_node import build_tree_from_element
+from core.disk_cache import DiskCache
+from core.llm_client import load_config
+
+EXCLUDE_PACKAGE = ["com.android.systemui", "com.github.uiautomator"]
+
+_reduce_cache = None
+_reduce_cache_lock = threading.Lock()
+
+
+class ReducedXMLCache:
+    """
+    精简文本的缓存：同一页面在相邻事件中作为stop_xml/start_xml反复出现，只需精简一次。
+    key为目标根节点XML与process参数的摘要，内存中保留最近使用的max_entries条，可选的磁盘缓存跨进程复用
+    """
+
+    def __init__(self, max_entries=1024, disk_cache=None):
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(root, **options):
+        digest = hashlib.sha256(etree.tostring(root, encoding="utf-8", with_tail=False))
+        digest.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.disk_cache is not None:
+            content = self.disk_cache.get(key)
+            if content is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, content)
+                return content
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, content):
+        with self._lock:
+            self._put_memory(key, content)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, content)
+
+    def _put_memory(self, key, content):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = content
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+                "entries": len(self.entries),
+            }
+
+
+def get_reduce_cache(config=None):
+    """
+    进程内共享的精简文本缓存，[cache] reduce_cache_size为0且reduce_cache_dir为空时不启用
+    """
+    global _reduce_cache
+    with _reduce_cache_lock:
+        if _reduce_cache is None:
+            if config is None:
+                config = load_config()
+            max_entries = config.getint('cache', 'reduce_cache_size', fallback=1024)
+            cache_dir = config.get('cache', 'reduce_cache_dir', fallback='')
+            if max_entries <= 0 and cache_dir == '':
+                return None
+            disk_cache = None
+            if cache_dir != '':
+                max_bytes = config.getint('cache', 'reduce_cache_max_mb', fallback=256) * 1024 * 1024
+                disk_cache = DiskCache(cache_dir, max_bytes)
+            _reduce_cache = ReducedXMLCache(max_entries, disk_cache)
+        return _reduce_cache
+
+
+class UIHierarchy:
+    """
+    一个页面XML只解析一次，提供根节点选择、WebView检测、activity/fragment提取和精简文本
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.root = etree.fromstring(xml.encode('utf-8'))
+        self._tree = None
+        self._tree_built = False
+
+    def select_target_root(self):
+        # iterate all the root nodes from the xml node, and select the one we want
+        for child in self.root:
+            if child.tag == "node" and child.get("package") in EXCLUDE_PACKAGE:
+                continue
+            return child
+        return None
+
+    def has_webview(self):
+        for node in self.root.iterdescendants("node"):
+            if node.get("base-class") == "android.webkit.WebView":
+                return True
+        return False
+
+    @property
+    def tree(self):
+        if not self._tree_built:
+            self._tree = build_tree_from_element(self.root)
+            self._tree_built = True
+        return self._tree
+
+    # 排序后返回，保证同一页面生成的prompt逐字节一致
+    def get_activity_list(self):
+        return sorted(self.tree.get_activity_list()) if self.tree is not None else []
+
+    def get_fragment_list(self):
+        return sorted(self.tree.get_fragment_list()) if self.tree is not None else []
+
+    def reduce(self, app_name, level=1, str_type="plain_text", remove_system_bar=True, use_bounds=False,
+               merge_switch=False, use_cache=True):
+        target_root = self.select_target_root()
+        if target_root is None:
+            raise ValueError("no target root node in xml")
+        options = dict(app_name=app_name, level=level, str_type=str_type, remove_system_bar=remove_system_bar,
+                       use_bounds=use_bounds, merge_switch=merge_switch)
+        cache = get_reduce_cache() if use_cache else None
+        if cache is not None:
+            key = cache.make_key(target_root, **options)
+            reduced = cache.get(key)
+            if reduced is not None:
+                return reduced
+        # UIXMLTree会原地修改节点，拷贝一份已解析的元素，不再重新解析
+        reduced = UIXMLTree().process(copy.deepcopy(target_root), **options)
+        if cache is not None:
+            cache.put(key, reduced)
+        return reduced
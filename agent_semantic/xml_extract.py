@@ -1,14 +1,74 @@
 from typing import Dict
 from lxml import etree
-import xmltodict
 import json
-import uuid
 import copy
+import difflib
+import hashlib
 import re
 '''
 XML树抽象方法
 '''
 
+
+def element_to_dict(element):
+    # 与 xmltodict.parse(etree.tostring(element), attr_prefix="") 的结果一致，省去序列化后再解析一次
+    return {element.tag: _element_value(element)}
+
+
+def _element_value(element):
+    value = dict(element.attrib)
+    texts = [element.text or '']
+    for child in element:
+        texts.append(child.tail or '')
+        if not isinstance(child.tag, str):
+            # 注释等非元素节点
+            continue
+        child_value = _element_value(child)
+        if child.tag in value:
+            if isinstance(value[child.tag], list):
+                value[child.tag].append(child_value)
+            else:
+                value[child.tag] = [value[child.tag], child_value]
+        else:
+            value[child.tag] = child_value
+    text = ''.join(texts).strip()
+    if not value:
+        return text if text else None
+    if text:
+        value['#text'] = text
+    return value
+
+
+def _indent(line):
+    return len(line) - len(line.lstrip(" "))
+
+
+def diff_plain_text(pre_text, after_text):
+    """
+    对比两个页面的plain_text精简结果，只输出变化的行：'- '为删除，'+ '为新增，
+    '  '为变化所在的父节点（上下文），页面没有变化时返回空字符串
+    """
+    pre_lines = [line for line in pre_text.split("\n") if line.strip() != ""]
+    after_lines = [line for line in after_text.split("\n") if line.strip() != ""]
+    result = []
+    emitted_context = set()
+    matcher = difflib.SequenceMatcher(None, pre_lines, after_lines, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal":
+            continue
+        # 向前找到第一个缩进更小的行作为父节点上下文
+        first_line = pre_lines[i1] if i1 < i2 else after_lines[j1]
+        for k in range(i1 - 1, -1, -1):
+            if _indent(pre_lines[k]) < _indent(first_line):
+                if k not in emitted_context:
+                    emitted_context.add(k)
+                    result.append("  " + pre_lines[k])
+                break
+        result += ["- " + line for line in pre_lines[i1:i2]]
+        result += ["+ " + line for line in after_lines[j1:j2]]
+    return "\n".join(result)
+
+
 class UIXMLTree:
     def __init__(self):
         self.root = None
@@ -28,7 +88,11 @@ class UIXMLTree:
 
     def process(self, xml_string, app_name, level=1, str_type="json", remove_system_bar=True, use_bounds=False,
                 merge_switch=False):
-        self.root = etree.fromstring(xml_string.encode('utf-8'))
+        # xml_string可以是XML字符串，也可以是已解析的lxml元素（会被原地修改，需要时由调用方先拷贝）
+        if isinstance(xml_string, etree._Element):
+            self.root = xml_string
+        else:
+            self.root = etree.fromstring(xml_string.encode('utf-8'))
         self.cnt = 0
         self.node_to_xpath: Dict[str, list[str]] = {}
         self.node_to_name = {}
@@ -45,7 +109,7 @@ class UIXMLTree:
             processor()
         self.reindex()
 
-        self.xml_dict = xmltodict.parse(etree.tostring(self.root, encoding='utf-8'), attr_prefix="")
+        self.xml_dict = element_to_dict(self.root)
         self.traverse_dict(self.xml_dict)
         # print("cnt:", self.cnt)
         if "json" == str_type:
@@ -158,7 +222,8 @@ class UIXMLTree:
         if 'NAF' in node.attrib:
             del node.attrib['NAF']
 
-    def get_xpath(self, node):
+    def get_xpath(self, node, class_index):
+        # class_index为node在父节点下同class兄弟节点中的序号（从1开始），由get_xpath_all_new遍历时计算
         if node.tag == 'hierarchy':
             return '/'
         elif  node.tag == 'span-node':
@@ -169,16 +234,13 @@ class UIXMLTree:
                 return '/'
         else:
             if node.attrib.get("resource-id", "") != "":
-                my_path = f'//*[@resource-id="{node.attrib["resource-id"]}"]'
-                candi_nodes = self.root.xpath(my_path)
-                if len(candi_nodes) == 1:
-                    return my_path
+                # 等价于在整个文档上执行 //*[@resource-id="..."] 且只命中一个节点
+                if self.get_attr_count("xpath-resource-id", node.attrib["resource-id"]) == 1:
+                    return f'//*[@resource-id="{node.attrib["resource-id"]}"]'
 
             parent = node.getparent()
             if parent is not None:
-                children = parent.xpath(f'./*[@class="{node.attrib.get("class", "")}"]')
-                index = children.index(node) + 1
-                return parent.attrib['xpath2'] + '/' + node.attrib['class'] + f'[{index}]'
+                return parent.attrib['xpath2'] + '/' + node.attrib['class'] + f'[{class_index}]'
             else:
                 return '/'
 
@@ -200,51 +262,36 @@ class UIXMLTree:
         else:
             self.mapCount[collection_key][key] += 1
 
-    def get_xpath_new(self, node):
+    def get_xpath_new(self, node, parent_steps, class_index):
         # 为给定的 XML 节点生成一个唯一的 XPath 表达式，来实现能否将子节点往上合并的过程
-        array = []
-        while node is not None:
-            if node.tag != "node":
-                break
-            parent = node.getparent()
-            if self.get_attr_count("tag", node.tag) == 1:
-                array.append(f'*[@label="{node.tag}"]')
-                break
-            elif self.get_attr_count("resource-id", node.attrib["resource-id"]) == 1:
-                array.append(f'*[@resource-id="{node.attrib["resource-id"]}"]')
-                break
-            elif self.get_attr_count("text", node.attrib.get("text", "")) == 1:
-                array.append(f'*[@text="{node.attrib["text"]}"]')
-                break
-            elif self.get_attr_count("content-desc", node.attrib.get("content-desc", "")) == 1:
-                array.append(f'*[@content-desc="{node.attrib["content-desc"]}"]')
-                break
-            elif self.get_attr_count("class", node.attrib["class"]) == 1:
-                array.append(f'{node.attrib["class"]}')
-                break
-            elif parent is None:
-                array.append(f'{node.tag}')
-            else:
-                index = 0
-                children = list(parent)
-                node_id = children.index(node)
-                for _id, child in enumerate(children):
-                    if child.attrib["class"] == node.attrib["class"]:
-                        index += 1
-                    if node_id == _id:
-                        break
-                array.append(f'{node.attrib["class"]}[{index}]')
-            node = parent
-
-        array.reverse()
-        xpath = "//" + "/".join(array)
-        return xpath
-
-    def get_xpath_all_new(self, node):
-        node.attrib['xpath1'] = self.get_xpath_new(node)
-        node.attrib['xpath2'] = self.get_xpath(node)
+        # 返回XPath的各级片段，parent_steps为父节点的片段，节点不唯一时在父节点路径后追加 class[序号]
+        if node.tag != "node":
+            return []
+        if self.get_attr_count("tag", node.tag) == 1:
+            return [f'*[@label="{node.tag}"]']
+        elif self.get_attr_count("resource-id", node.attrib["resource-id"]) == 1:
+            return [f'*[@resource-id="{node.attrib["resource-id"]}"]']
+        elif self.get_attr_count("text", node.attrib.get("text", "")) == 1:
+            return [f'*[@text="{node.attrib["text"]}"]']
+        elif self.get_attr_count("content-desc", node.attrib.get("content-desc", "")) == 1:
+            return [f'*[@content-desc="{node.attrib["content-desc"]}"]']
+        elif self.get_attr_count("class", node.attrib["class"]) == 1:
+            return [f'{node.attrib["class"]}']
+        elif node.getparent() is None:
+            return [f'{node.tag}']
+        else:
+            return parent_steps + [f'{node.attrib["class"]}[{class_index}]']
+
+    def get_xpath_all_new(self, node, parent_steps=None, class_index=0):
+        # 一次先序遍历生成所有节点的xpath1/xpath2，父节点的路径和兄弟序号随遍历传递，不再逐层回溯
+        steps = self.get_xpath_new(node, parent_steps or [], class_index)
+        node.attrib['xpath1'] = "//" + "/".join(steps)
+        node.attrib['xpath2'] = self.get_xpath(node, class_index)
+        class_count = {}
         for child in list(node):
-            self.get_xpath_all_new(child)
+            child_class = child.attrib.get("class")
+            class_count[child_class] = class_count.get(child_class, 0) + 1
+            self.get_xpath_all_new(child, steps, class_count[child_class])
 
     def get_first_five_words(self, text):
         words = text.split()
@@ -335,7 +382,8 @@ class UIXMLTree:
             if 'name' in node.attrib:
                 del node.attrib['name']
             return
-        node.tag = 'n' + str(uuid.uuid4().hex[:4])
+        # 按先序遍历序号命名，相同的页面总是得到相同的tag，且不会重名
+        node.tag = 'n' + str(self.cnt)
 
         if node.tag in self.node_to_xpath:
             self.node_to_xpath[node.tag].append(node.attrib['xpath1'])
@@ -492,6 +540,10 @@ class UIXMLTree:
             # if "content-desc" in element.attrib:
             self.inc_attr_count("content-desc", element.attrib.get("content-desc", ""))
             self.inc_attr_count("tag-page_xml", element.attrib.get("tag-page_xml", ""))
+        # get_xpath中的 //*[@resource-id=...] 作用于整个文档中的所有元素
+        for element in self.root.getroottree().iter(tag=etree.Element):
+            if "resource-id" in element.attrib:
+                self.inc_attr_count("xpath-resource-id", element.attrib["resource-id"])
 
         # self.get_xpath_all(self.root)
         self.get_xpath_all_new(self.root)
@@ -528,28 +580,45 @@ class UIXMLTree:
                 return False
         return True
 
-    def check_unique(self, node, node_list):
-        for element in node_list:
-            if self.same_subtree(node, element):
-                return False
-        return True
+    def subtree_digests(self, root):
+        """
+        自底向上计算root下每个节点的Merkle摘要（class、resource-id、func-desc和子节点摘要），
+        两个节点摘要相同等价于same_subtree为True
+        :return: 节点 -> 摘要 的字典
+        """
+        digests = {}
+        # 先序遍历的逆序保证子节点先于父节点计算
+        for element in reversed(list(root.iter(tag=etree.Element))):
+            fields = [element.attrib.get('class', ''), element.attrib.get('resource-id', ''),
+                      element.attrib.get('func-desc', '')]
+            fields += [digests[child] for child in element.iterchildren(tag=etree.Element)]
+            digests[element] = hashlib.sha1("\x1f".join(fields).encode('utf-8')).hexdigest()
+        return digests
 
     def merge_recycle_list(self, recycle_nodes):
         for element in self.root.iter():
             if 'scrollable' in element.attrib and element.attrib['scrollable'] == 'true':
+                # 当前列表已有子节点的摘要集合，去重变为集合查找
+                element_digests = self.subtree_digests(element)
+                existing = {element_digests[child] for child in element.iterchildren(tag=etree.Element)}
                 # find same recycle node
                 for node in recycle_nodes:
                     if element.attrib['class'] == node.attrib['class'] and element.attrib['resource-id'] == node.attrib[
                         'resource-id'] and element.attrib['func-desc'] == node.attrib['func-desc']:
+                        node_digests = self.subtree_digests(node)
                         # merge
-                        for child in list(node):
-                            if self.check_unique(child, list(element)):
+                        for child in list(node.iterchildren(tag=etree.Element)):
+                            child_digest = node_digests[child]
+                            if child_digest not in existing:
+                                existing.add(child_digest)
                                 element.append(child)
 
     def check_scroll_bottom(self, tree1, tree2):
-        child1 = list(tree1)
-        child2 = list(tree2)
-        for i in range(len(child1)):
-            if not self.same_subtree(child1[i], child2[i]):
-                return False
-        return True
+        # tree1的子节点序列与tree2开头的子节点序列逐个相同
+        child1 = list(tree1.iterchildren(tag=etree.Element))
+        child2 = list(tree2.iterchildren(tag=etree.Element))
+        if len(child2) < len(child1):
+            return False
+        digests1 = self.subtree_digests(tree1)
+        digests2 = self.subtree_digests(tree2)
+        return [digests1[child] for child in child1] == [digests2[child] for child in child2[:len(child1)]]
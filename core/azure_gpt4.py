@@ -1,57 +1,143 @@
 import json
 import re
-import time
-import openai
-import configparser
-import base64
+import threading
 from colorama import Fore
 from typing import List
+from core.rate_limit import LLMScheduler, PRIORITY_SEMANTIC
+from core.llm_cache import LLMResponseCache
+from core.image_prep import ImagePreparer
+from core.llm_client import load_config, get_llm_client
 
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+_image_preparer = None
+_image_preparer_lock = threading.Lock()
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
 
+def estimate_tokens(text):
+    # 粗略估计token数，英文约4个字符一个token
+    return len(text) // 4 + 1
 
-def ask_gpt4o(system_prompt, user_prompt, images: List[str], need_json=True) -> dict:
-    config = configparser.ConfigParser()
-    config.read('../config/config.ini')
 
-    # 获取GPT API密钥和endpoint
-    ak = config.get('gpt4', 'gpt_key')
-    endpoint = config.get('gpt4', 'endpoint')
+def get_scheduler(config=None):
+    """
+    进程内共享的LLM调用调度器，语义标注、向量化和执行阶段的所有线程共用同一份RPM/TPM预算
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            if config is None:
+                config = load_config()
+            _scheduler = LLMScheduler(rpm=config.getint('gpt4', 'requests_per_minute', fallback=0),
+                                      tpm=config.getint('gpt4', 'tokens_per_minute', fallback=0),
+                                      base_delay=config.getfloat('gpt4', 'backoff_base', fallback=1.0),
+                                      max_delay=config.getfloat('gpt4', 'backoff_max', fallback=60.0),
+                                      max_attempts=config.getint('gpt4', 'max_attempts', fallback=6))
+        return _scheduler
+
+
+def get_llm_cache(config=None):
+    """
+    进程内共享的LLM回答缓存，[cache] llm_cache_dir为空时不启用
+    """
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            if config is None:
+                config = load_config()
+            cache_dir = config.get('cache', 'llm_cache_dir', fallback='')
+            if cache_dir == '':
+                return None
+            max_bytes = config.getint('cache', 'llm_cache_max_mb', fallback=512) * 1024 * 1024
+            _llm_cache = LLMResponseCache(cache_dir, max_bytes)
+        return _llm_cache
+
+
+def get_image_preparer(config=None):
+    """
+    进程内共享的图片预处理器，[gpt4] image_max_dim为0时不缩放
+    """
+    global _image_preparer
+    with _image_preparer_lock:
+        if _image_preparer is None:
+            if config is None:
+                config = load_config()
+            _image_preparer = ImagePreparer(max_dim=config.getint('gpt4', 'image_max_dim', fallback=1024),
+                                            image_format=config.get('gpt4', 'image_format', fallback='JPEG'),
+                                            quality=config.getint('gpt4', 'image_quality', fallback=85))
+        return _image_preparer
+
+
+def parse_answer(answer, need_json=True):
+    """
+    从模型回答中提取结果，need_json时返回第一个JSON对象，解析失败返回None
+    """
+    if not need_json:
+        return answer
+    pattern = r'\{[^}]*\}'
+    try:
+        matches = re.findall(pattern, answer)
+        # Assuming we want the first match (in this case, there is only one)
+        if matches:
+            return json.loads(matches[0])
+    except Exception as e:
+        print(Fore.RED + "re match Exception: " + str(e) + Fore.RESET)
+    return None
+
+
+def ask_gpt4o(system_prompt, user_prompt, images: List[str], need_json=True, use_cache=True,
+              priority=PRIORITY_SEMANTIC) -> dict:
+    """
+    :param priority: 等待RPM/TPM预算时的优先级，执行阶段传入PRIORITY_EXECUTE
+    """
+    config = load_config()
+    scheduler = get_scheduler(config)
+    model_name = "gpt-4o-2024-05-13"
+    temperature = 0.0
+    max_tokens = 4096
+
+    # 相同输入直接复用缓存中的回答
+    llm_cache = get_llm_cache(config) if use_cache else None
+    if llm_cache is not None:
+        cache_key = llm_cache.make_key(model_name, system_prompt, user_prompt, images, temperature)
+        cached_answer = llm_cache.get(cache_key)
+        if cached_answer is not None:
+            result = parse_answer(cached_answer, need_json)
+            if result is not None:
+                return result
     content = [
         {
             "type": "text",
             "text": user_prompt
         }
     ]
+    image_preparer = get_image_preparer(config)
+    original_bytes, uploaded_bytes = 0, 0
     for img in images:
-        base64_img = encode_image(img)
+        image_url, original_size, uploaded_size = image_preparer.prepare(img)
+        original_bytes += original_size
+        uploaded_bytes += uploaded_size
         content.append({
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_img}"
+                "url": image_url
             }
         })
-    api_version = "2024-03-01-preview"
-    ak = ak
-    model_name = "gpt-4o-2024-05-13"
-    max_tokens = 4096
-    client = openai.AzureOpenAI(
-        azure_endpoint=endpoint,
-        api_version=api_version,
-        api_key=ak,
-    )
+    if images:
+        print(f"images: {len(images)}, upload {uploaded_bytes} bytes (original {original_bytes} bytes)")
+    # 每张图片按固定token数估算
+    request_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + 1000 * len(images) + max_tokens
+    client = get_llm_client(config)
 
+    # 接口错误由调度器退避重试，这里只对无法解析的回答重新请求
     max_attempts = 5
-    attempt = 0
-    have_answer = False
-    while attempt < max_attempts:
+    for attempt in range(max_attempts):
         try:
-            completion = client.chat.completions.create(
+            completion = scheduler.call(lambda: client.chat(
                 model=model_name,
-                temperature=0.0,
+                temperature=temperature,
                 messages=[
                     {
                         "role": "system",
@@ -63,34 +149,18 @@ def ask_gpt4o(system_prompt, user_prompt, images: List[str], need_json=True) ->
                     }
                 ],
                 max_tokens=max_tokens
-            )
-            have_answer = True
+            ), request_tokens, priority)
         except Exception as e:
             print(Fore.RED + "gpt4o Exception: " + str(e) + Fore.RESET)
-            if 'qpm limit' in str(e):
-                time.sleep(20)
-            else:
-                time.sleep(5)
-            attempt += 1
-            if attempt == max_attempts:
-                return str(e) + "gpt ans failed, parse failed"
-        if have_answer:
-            response = json.loads(completion.model_dump_json())
-            # print(Fore.YELLOW + response['choices'][0]['message']['content'] + Fore.RESET)
-            if not need_json:
-                return response['choices'][0]['message']['content']
-            else:
-                pattern = r'\{[^}]*\}'
-                try:
-                    matches = re.findall(pattern, response['choices'][0]['message']['content'])
-                    # Assuming we want the first match (in this case, there is only one)
-                    if matches:
-                        extracted_info = matches[0]
-                        return json.loads(extracted_info)
-                    else:
-                        attempt += 1
-                except Exception as e:
-                    print(Fore.RED + "re match Exception: " + str(e) + Fore.RESET)
-        else:
-            attempt += 1
+            return str(e) + "gpt ans failed, parse failed"
+        if completion.usage is not None:
+            scheduler.settle(request_tokens, completion.usage.total_tokens)
+        response = json.loads(completion.model_dump_json())
+        answer = response['choices'][0]['message']['content']
+        # print(Fore.YELLOW + answer + Fore.RESET)
+        result = parse_answer(answer, need_json)
+        if result is not None:
+            if llm_cache is not None:
+                llm_cache.put(cache_key, answer)
+            return result
     return "None"
@@ -1,23 +1,112 @@
-from openai import OpenAI
-import configparser
-def embeddings(words):
-    # gets API Key from environment variable OPENAI_API_KEY
-    config = configparser.ConfigParser()
-    config.read('../config/config.ini')
-    key = config.get('gpt4', 'embedding_key')
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from core.llm_client import load_config, get_llm_client
+from core.azure_gpt4 import estimate_tokens, get_scheduler
+from core.rate_limit import PRIORITY_SEMANTIC
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+class EmbeddingCache:
+    """
+    持久化的 文本hash -> 向量 缓存，SemanticAgent和ExecuteAgent共用
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embedding (hash TEXT PRIMARY KEY, vector BLOB)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        result = {}
+        keys = list(keys)
+        with self._lock:
+            # sqlite单条语句的参数个数有限，分段查询
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embedding WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+                for key, blob in rows:
+                    vector = array('d')
+                    vector.frombytes(blob)
+                    result[key] = vector.tolist()
+            self.hits += len(result)
+            self.misses += len(keys) - len(result)
+        return result
+
+    def put_many(self, items):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embedding (hash, vector) VALUES (?, ?)",
+                                   [(key, array('d', vector).tobytes()) for key, vector in items])
+            self._conn.commit()
+
+    def record_api_call(self):
+        with self._lock:
+            self.api_calls += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "api_calls": self.api_calls}
+
+
+def get_embedding_cache(config=None):
+    """
+    进程内共享的向量缓存，[cache] embedding_cache_path为空时不启用
+    """
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            if config is None:
+                config = load_config()
+            path = config.get('cache', 'embedding_cache_path', fallback='')
+            if path == '':
+                return None
+            _embedding_cache = EmbeddingCache(path)
+        return _embedding_cache
+
+
+def embeddings(words, batch_size=None, priority=PRIORITY_SEMANTIC):
+    config = load_config()
     model = config.get('gpt4', 'embedding_model')
-    base_url = config.get('gpt4', 'embedding_url')
-
-    client = OpenAI(
-        api_key=key,
-        base_url=base_url
-    )
-
-    resp = client.embeddings.create(
-        model=model,
-        input=words,
-        encoding_format="float"
-    )
-    res = [item.embedding for item in resp.data]
-    return res
+    if batch_size is None:
+        batch_size = config.getint('gpt4', 'embedding_batch_size', fallback=256)
 
+    # 去重后先查缓存，只对未命中的文本请求接口
+    distinct_words = list(dict.fromkeys(words))
+    cache = get_embedding_cache(config)
+    vectors = {}
+    if cache is not None:
+        keys = {word: cache.make_key(model, word) for word in distinct_words}
+        cached = cache.get_many(keys.values())
+        for word in distinct_words:
+            if keys[word] in cached:
+                vectors[word] = cached[keys[word]]
+    missing_words = [word for word in distinct_words if word not in vectors]
+
+    if missing_words:
+        client = get_llm_client(config)
+        scheduler = get_scheduler(config)
+        for i in range(0, len(missing_words), batch_size):
+            batch = missing_words[i:i + batch_size]
+            request_tokens = sum(estimate_tokens(word) for word in batch)
+            batch_vectors = scheduler.call(lambda: client.embed(batch, model), request_tokens, priority)
+            vectors.update(zip(batch, batch_vectors))
+            if cache is not None:
+                cache.record_api_call()
+                cache.put_many([(keys[word], vector) for word, vector in zip(batch, batch_vectors)])
+    res = [vectors[word] for word in words]
+    return res
@@ -1,6 +1,8 @@
 import json
+import threading
+from collections import OrderedDict
 from py2neo import Graph, Node, Relationship
-import configparser
+from core.llm_client import load_config
 
 
 def md5(input_str):
@@ -8,18 +10,254 @@ def md5(input_str):
     return hashlib.md5(input_str.encode('utf-8')).hexdigest()
 
 
+def get_action_hash(node_info):
+    start_hash = node_info['start_state']['hash_id']
+    end_hash = node_info['stop_state']['hash_id']
+    action_str = f"{start_hash}-{end_hash}-{node_info['action_state']['resource_id']}-{node_info['action_state']['event_type']}"
+    return md5(action_str)
+
+
+BUILD_GRAPH_NODES_QUERY = """
+UNWIND $rows AS row
+MERGE (start:Scene {hash_id: row.start.hash_id})
+SET start += row.start
+MERGE (stop:Scene {hash_id: row.stop.hash_id})
+SET stop += row.stop
+MERGE (action:Action {hash_id: row.action.hash_id})
+SET action += row.action
+MERGE (start)-[:LEADS_TO]->(action)
+MERGE (action)-[:LEADS_TO]->(stop)
+"""
+
+SCENE_INFO_QUERY = """
+UNWIND $hash_ids AS hash_id
+MATCH (scene:Scene {hash_id: hash_id})
+RETURN scene.hash_id AS hash_id, scene.name AS name, scene.description AS description
+"""
+
+ACTION_INFO_QUERY = """
+UNWIND $hash_ids AS hash_id
+MATCH (action:Action {hash_id: hash_id})
+RETURN action.hash_id AS hash_id, action.name AS name, action.description AS description,
+       action.element_semantic AS element_semantic, action.bounds AS bounds, action.resource_id AS resource_id
+"""
+
+# 每个动作取一个到达场景，与get_scene_by_action_hash_id取第一条结果一致
+ACTION_INFO_WITH_ARRIVAL_QUERY = """
+UNWIND $hash_ids AS hash_id
+MATCH (action:Action {hash_id: hash_id})
+OPTIONAL MATCH (action)-[:LEADS_TO]->(scene:Scene)
+WITH action, collect(scene)[0] AS arrival_scene
+RETURN action.hash_id AS hash_id, action.name AS name, action.description AS description,
+       action.element_semantic AS element_semantic, action.bounds AS bounds, action.resource_id AS resource_id,
+       arrival_scene
+"""
+
+OUTGOING_ACTIONS_QUERY = """
+MATCH (s:Scene {hash_id: $hash_id})-[r:LEADS_TO]->(a:Action)
+RETURN a.hash_id AS hash_id, a.name AS name, a.description AS description, a.bounds AS bounds,
+       a.resource_id AS resource_id, a.element_semantic AS element_semantic
+"""
+
+# 一次读出全部 Scene->Action->Scene 邻接关系
+ADJACENCY_QUERY = """
+MATCH (s:Scene)-[:LEADS_TO]->(a:Action)
+OPTIONAL MATCH (a)-[:LEADS_TO]->(t:Scene)
+WITH s, a, collect(t)[0] AS arrival_scene
+RETURN s.hash_id AS scene_hash, a.hash_id AS hash_id, a.name AS name, a.description AS description,
+       a.bounds AS bounds, a.resource_id AS resource_id, a.element_semantic AS element_semantic, arrival_scene
+"""
+
+# 所有查询都按hash_id匹配节点，唯一约束同时会建立对应的索引
+SCHEMA_CONSTRAINTS = [
+    ("scene_hash_id_unique", "Scene", "hash_id"),
+    ("action_hash_id_unique", "Action", "hash_id"),
+]
+
+
+def scene_node_to_info(scene):
+    return {
+        "elementId": scene.get('elementId'),
+        "id": scene.get('id'),
+        "description": scene.get('description'),
+        "hash_id": scene.get('hash_id'),
+        "name": scene.get('name')
+    }
+
+
+def action_record_to_outgoing(record):
+    return {
+        "hash_id": record['hash_id'],
+        "name": record["name"],
+        "element_semantic": record["element_semantic"],
+        "description": record["description"],
+        # 反序列化bounds
+        "bounds": json.loads(record['bounds']),
+        "resource_id": record["resource_id"],
+    }
+
+
+class AdjacencyCache:
+    """
+    进程内的 Scene->Action->Scene 邻接缓存，代码生成期间图基本只读，重复的遍历查询不再访问数据库：
+    full模式首次使用时一次读入整个图的邻接关系；lazy模式按场景/动作在未命中时查询，并按LRU保留max_entries项。
+    任何写操作都会清空缓存
+    """
+
+    def __init__(self, mode="lazy", max_entries=1024):
+        self.mode = mode
+        self.max_entries = max_entries
+        self.outgoing = OrderedDict()
+        self.arrival = OrderedDict()
+        self.loaded = False
+        # 每次失效加一，lazy模式下查询期间缓存被清空时，查询结果不再写入缓存
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load_full(self, graph):
+        outgoing, arrival = OrderedDict(), OrderedDict()
+        for record in graph.run(ADJACENCY_QUERY):
+            outgoing.setdefault(record["scene_hash"], []).append(action_record_to_outgoing(record))
+            if record["hash_id"] not in arrival:
+                arrival[record["hash_id"]] = scene_node_to_info(record["arrival_scene"]) \
+                    if record["arrival_scene"] is not None else None
+        self.outgoing, self.arrival, self.loaded = outgoing, arrival, True
+
+    def get(self, table, key, graph, fetch):
+        """
+        :param table: outgoing 或 arrival
+        :param fetch: lazy模式下未命中时查询数据库的函数
+        """
+        with self.lock:
+            if self.mode == "full" and not self.loaded:
+                self.load_full(graph)
+            cache = getattr(self, table)
+            if key in cache:
+                self.hits += 1
+                cache.move_to_end(key)
+                return cache[key]
+            self.misses += 1
+            if self.mode == "full":
+                # 整个图已经读入，不存在的key就是没有对应的边
+                return [] if table == "outgoing" else None
+            generation = self.generation
+        value = fetch(key)
+        with self.lock:
+            if generation != self.generation:
+                # 查询期间发生了写操作，结果可能已过期，只返回给本次调用
+                return value
+            cache = getattr(self, table)
+            cache[key] = value
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.outgoing.clear()
+            self.arrival.clear()
+            self.loaded = False
+
+    def stats(self):
+        with self.lock:
+            return {"mode": self.mode, "scenes": len(self.outgoing), "actions": len(self.arrival),
+                    "hits": self.hits, "misses": self.misses}
+
+
 class GraphManager:
+    # 同一个数据库的连接在进程内复用，py2neo的Graph内部维护连接池
+    _graph_pool = {}
+    _graph_pool_lock = threading.Lock()
+    # 同一个数据库的邻接缓存在进程内共享，任何实例的写操作都会使其失效
+    _adjacency_caches = {}
+    # 已成功创建约束的数据库
+    _schema_checked = set()
+    _schema_lock = threading.Lock()
+
     def __init__(self, name):
         # 读取配置文件
-        config = configparser.ConfigParser()
-        config.read('../config/config.ini')
+        config = load_config()
 
         # 从配置文件中获取Neo4j的连接信息
         uri = config.get('neo4j', 'uri')
         user = config.get('neo4j', 'user')
         password = config.get('neo4j', 'password')
+        self.batch_size = config.getint('neo4j', 'batch_size', fallback=1000)
+        ensure_schema = config.getboolean('neo4j', 'ensure_schema', fallback=True)
         # 连接到图形数据库
-        self.graph = Graph(uri, user=user, password=password, name=name)
+        with GraphManager._graph_pool_lock:
+            key = (uri, user, name)
+            if key not in GraphManager._graph_pool:
+                GraphManager._graph_pool[key] = Graph(uri, user=user, password=password, name=name)
+            self.graph = GraphManager._graph_pool[key]
+            adjacency_cache = config.get('neo4j', 'adjacency_cache', fallback='off')
+            if adjacency_cache not in ['off', 'lazy', 'full']:
+                raise ValueError(f"Invalid adjacency_cache: {adjacency_cache}. Must be 'off', 'lazy' or 'full'.")
+            if adjacency_cache != 'off' and key not in GraphManager._adjacency_caches:
+                GraphManager._adjacency_caches[key] = AdjacencyCache(
+                    adjacency_cache, config.getint('neo4j', 'adjacency_cache_size', fallback=1024))
+            self.adjacency_cache = GraphManager._adjacency_caches.get(key)
+        # 创建约束需要访问数据库，不在连接池的锁内执行；同时创建的实例等待约束建好后再写入，
+        # 约束全部创建成功后才记为已检查，失败时下一个实例重试。语句幂等，已存在时不做任何事
+        if ensure_schema:
+            with GraphManager._schema_lock:
+                if key not in GraphManager._schema_checked and self.ensure_schema():
+                    GraphManager._schema_checked.add(key)
+
+    def ensure_schema(self):
+        """
+        为Scene.hash_id和Action.hash_id创建唯一约束（及其索引）
+        :return: 所有约束是否都创建成功
+        """
+        success = True
+        for constraint_name, label, prop in SCHEMA_CONSTRAINTS:
+            queries = [
+                # Neo4j 4.4 / 5.x
+                f"CREATE CONSTRAINT {constraint_name} IF NOT EXISTS FOR (n:{label}) REQUIRE n.{prop} IS UNIQUE",
+                # Neo4j 4.1 - 4.3
+                f"CREATE CONSTRAINT {constraint_name} IF NOT EXISTS ON (n:{label}) ASSERT n.{prop} IS UNIQUE",
+            ]
+            error = None
+            for query in queries:
+                try:
+                    self.graph.run(query)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+            if error is not None:
+                # 常见原因是库中已有重复的hash_id，需要先清理数据
+                print(f"Failed to create constraint on {label}.{prop}: {error}")
+                success = False
+        return success
+
+    def check_schema(self):
+        """
+        检查hash_id上的唯一约束和索引是否存在
+        :return: 缺失的约束和索引列表
+        """
+        constraints = set()
+        for record in self.graph.run("SHOW CONSTRAINTS").data():
+            if "UNIQUE" in str(record.get("type", "")).upper():
+                for label in record.get("labelsOrTypes") or []:
+                    constraints.add((label, tuple(record.get("properties") or [])))
+        indexes = set()
+        for record in self.graph.run("SHOW INDEXES").data():
+            for label in record.get("labelsOrTypes") or []:
+                indexes.add((label, tuple(record.get("properties") or [])))
+        missing_constraints, missing_indexes = [], []
+        for _, label, prop in SCHEMA_CONSTRAINTS:
+            if (label, (prop,)) not in constraints:
+                missing_constraints.append(f"{label}.{prop}")
+            if (label, (prop,)) not in indexes:
+                missing_indexes.append(f"{label}.{prop}")
+        return {
+            "missing_constraints": missing_constraints,
+            "missing_indexes": missing_indexes,
+        }
 
     def update_node_properties(self, node_type, hash_id, properties):
         """
@@ -40,6 +278,7 @@ class GraphManager:
         """
         # 执行查询并传入参数
         result = self.graph.run(query, hash_id=hash_id, **properties).data()
+        self.invalidate_cache()
 
         if result:
             print(f"{node_type.capitalize()} node with hash_id {hash_id} has been updated.")
@@ -52,6 +291,7 @@ class GraphManager:
           DELETE r
           """
         self.graph.run(query, start_hash_id=start_hash_id, end_hash_id=end_hash_id)
+        self.invalidate_cache()
 
     def delete_scene_and_relationships_by_hash_id(self, scene_hash_id):
         """
@@ -67,10 +307,21 @@ class GraphManager:
 
         # 执行查询，传递scene的hash_id作为参数
         self.graph.run(query, scene_hash_id=scene_hash_id)
+        self.invalidate_cache()
 
         print(f"Scene with hash_id {scene_hash_id} and all related relationships have been deleted.")
 
+    def invalidate_cache(self):
+        if self.adjacency_cache is not None:
+            self.adjacency_cache.invalidate()
+
     def get_scene_by_action_hash_id(self, action_hash_id):
+        if self.adjacency_cache is not None:
+            scene = self.adjacency_cache.get("arrival", action_hash_id, self.graph, self.query_scene_by_action_hash_id)
+            return dict(scene) if scene is not None else None
+        return self.query_scene_by_action_hash_id(action_hash_id)
+
+    def query_scene_by_action_hash_id(self, action_hash_id):
         # 编写Cypher查询，查找从指定action节点指向的scene节点
         query = """
         MATCH (a:Action {hash_id: $action_hash_id})-[:LEADS_TO]->(s:Scene)
@@ -82,14 +333,7 @@ class GraphManager:
         # 如果找到匹配的scene节点，提取并返回scene的属性
         if result:
             print(result)
-            scene = result[0]['s']
-            return {
-                "elementId": scene.get('elementId'),
-                "id": scene.get('id'),
-                "description": scene.get('description'),
-                "hash_id": scene.get('hash_id'),
-                "name": scene.get('name')
-            }
+            return scene_node_to_info(result[0]['s'])
         else:
             return None
 
@@ -99,95 +343,56 @@ class GraphManager:
         :param scene_hash_id: 场景的hash_id
         :return: 出度动作列表
         """
-        # 编写查询语句
-        query = """
-                    MATCH (s:Scene {hash_id: $hash_id})-[r:LEADS_TO]->(a:Action)
-                    RETURN a.hash_id AS hash_id, a.name AS name, a.description AS description, a.bounds AS bounds, 
-                           a.resource_id AS resource_id, a.element_semantic AS element_semantic
-                    """
-        # 执行查询
-        results = self.graph.run(query, hash_id=scene_hash_id)
-
-        # 收集所有结果
-        actions = []
-        for record in results:
-            # 反序列化bounds
-            bounds = json.loads(record['bounds'])
-            actions.append({
-                "hash_id": record['hash_id'],
-                "name": record["name"],
-                "element_semantic": record["element_semantic"],
-                "description": record["description"],
-                "bounds": bounds,
-                "resource_id": record["resource_id"],
-            })
-        return actions
+        if self.adjacency_cache is not None:
+            actions = self.adjacency_cache.get("outgoing", scene_hash_id, self.graph, self.query_outgoing_actions)
+            return [dict(action) for action in actions]
+        return self.query_outgoing_actions(scene_hash_id)
+
+    def query_outgoing_actions(self, scene_hash_id):
+        results = self.graph.run(OUTGOING_ACTIONS_QUERY, hash_id=scene_hash_id)
+        return [action_record_to_outgoing(record) for record in results]
 
     def get_info_from_scene_list(self, scene_list):
         """
-        根据场景列表获取场景信息
+        根据场景列表获取场景信息，整个列表用一条UNWIND查询
         :param scene_list: 场景列表
-        :return: 场景信息列表
-        """
-        # List to hold the results
-        scene_info_list = []
-
-        # Query template to retrieve scene information
-        query_template = """
-        MATCH (scene:Scene {hash_id: $hash_id})
-        RETURN scene.hash_id AS hash_id, scene.name AS name, scene.description AS description
+        :return: 场景信息列表，与scene_list顺序一致，不存在的场景跳过
         """
         try:
-            # Iterate over each scene hash in the list
-            for scene_hash in scene_list:
-                # Run the query with the current scene hash
-                result = self.graph.run(query_template, hash_id=scene_hash)
-                # Fetch all records
-                for record in result:
-                    # Append each scene's info to the list as a dictionary
-                    scene_info_list.append({
-                        "hash_id": scene_hash,
-                        "name": record["name"],
-                        "description": record["description"]
-                    })
-            return scene_info_list
+            result = self.graph.run(SCENE_INFO_QUERY, hash_ids=list(dict.fromkeys(scene_list)))
+            scenes = {record["hash_id"]: {
+                "hash_id": record["hash_id"],
+                "name": record["name"],
+                "description": record["description"]
+            } for record in result}
+            return [dict(scenes[scene_hash]) for scene_hash in scene_list if scene_hash in scenes]
         except Exception as e:
             print("An error occurred:", e)
             return []
 
-    def get_info_from_action_list(self, action_list):
+    def get_info_from_action_list(self, action_list, with_arrival_scene=False):
         """
-        根据动作列表获取动作信息
+        根据动作列表获取动作信息，整个列表用一条UNWIND查询
         :param action_list: 动作列表
-        :return: 动作信息列表
-        """
-        # List to hold the results
-        action_info_list = []
-
-        # Query template to retrieve action information
-        query_template = """
-        MATCH (action:Action {hash_id: $hash_id})
-        RETURN action.hash_id AS hash_id, action.name AS name, action.description AS description,
-               action.element_semantic AS element_semantic, action.bounds AS bounds, action.resource_id AS resource_id
-        """
-
-        # Iterate over each action hash in the list
-        for action_hash in action_list:
-            # Run the query with the current action hash
-            result = self.graph.run(query_template, hash_id=action_hash)
-            # Fetch all records
-            for record in result:
-                # Append each action's info to the list as a dictionary
-                action_info_list.append({
-                    "hash_id": record["hash_id"],
-                    "name": record["name"],
-                    "description": record["description"],
-                    "element_semantic": record["element_semantic"],
-                    "bounds": record["bounds"],
-                    "resource_id": record["resource_id"]
-                })
-
-        return action_info_list
+        :param with_arrival_scene: 同时查询每个动作到达的场景，结果的arrival_scene字段与get_scene_by_action_hash_id一致
+        :return: 动作信息列表，与action_list顺序一致，不存在的动作跳过
+        """
+        query = ACTION_INFO_WITH_ARRIVAL_QUERY if with_arrival_scene else ACTION_INFO_QUERY
+        actions = {}
+        for record in self.graph.run(query, hash_ids=list(dict.fromkeys(action_list))):
+            action_info = {
+                "hash_id": record["hash_id"],
+                "name": record["name"],
+                "description": record["description"],
+                "element_semantic": record["element_semantic"],
+                "bounds": record["bounds"],
+                "resource_id": record["resource_id"]
+            }
+            if with_arrival_scene:
+                action_info["arrival_scene"] = scene_node_to_info(record["arrival_scene"]) \
+                    if record["arrival_scene"] is not None else None
+            actions[record["hash_id"]] = action_info
+        return [dict(actions[action_hash]) for action_hash in action_list if action_hash in actions]
 
     def build_graph_node(self, node_info):
         """
@@ -195,10 +400,7 @@ class GraphManager:
         """
         # 根据start_state, action_state, stop_state在neo4j中构图，代表一个场景通过一个动作到达下一个场景，会传入很多个这样的view_info
         # 创建或获取开始场景节点
-        start_hash = node_info['start_state']['hash_id']
-        end_hash = node_info['stop_state']['hash_id']
-        action_str = f"{start_hash}-{end_hash}-{node_info['action_state']['resource_id']}-{node_info['action_state']['event_type']}"
-        action_hash = md5(action_str)
+        action_hash = get_action_hash(node_info)
         start_node = Node("Scene", hash_id=node_info['start_state']['hash_id'],
                           name=node_info['start_state']['name'],
                           description=node_info['start_state']['description'])
@@ -228,7 +430,128 @@ class GraphManager:
         # 创建关系：动作到结束场景
         action_to_stop_rel = Relationship(action_node, "LEADS_TO", stop_node)
         self.graph.merge(action_to_stop_rel)
+        self.invalidate_cache()
+
+    def build_graph_nodes(self, node_info_list, batch_size=None):
+        """
+        批量构图，与build_graph_node结果一致，每batch_size条记录用一条UNWIND语句在一个事务中写入
+        :param node_info_list: build_graph_node所用的node_info列表
+        :return: 写入的记录数
+        """
+        batch_size = batch_size or self.batch_size
+        rows = []
+        for node_info in node_info_list:
+            rows.append({
+                "start": {
+                    "hash_id": node_info['start_state']['hash_id'],
+                    "name": node_info['start_state']['name'],
+                    "description": node_info['start_state']['description'],
+                },
+                "stop": {
+                    "hash_id": node_info['stop_state']['hash_id'],
+                    "name": node_info['stop_state']['name'],
+                    "description": node_info['stop_state']['description'],
+                },
+                "action": {
+                    "hash_id": get_action_hash(node_info),
+                    "name": node_info['action_state']['name'],
+                    "element_semantic": node_info['action_state']['element_semantic'],
+                    "description": node_info['action_state']['description'],
+                    "bounds": json.dumps(node_info['action_state']['bounds']),
+                    "resource_id": node_info['action_state']['resource_id'],
+                    "event_type": node_info['action_state']['event_type'],
+                },
+            })
+        for i in range(0, len(rows), batch_size):
+            tx = self.graph.begin()
+            try:
+                tx.run(BUILD_GRAPH_NODES_QUERY, rows=rows[i:i + batch_size])
+                self.graph.commit(tx)
+            except Exception:
+                if not tx.closed:
+                    self.graph.rollback(tx)
+                raise
+            finally:
+                self.invalidate_cache()
+        return len(rows)
+
+
+class GraphReadCache:
+    """
+    单条用例内的读缓存：场景信息、动作信息（含到达场景）和场景出边按hash缓存，
+    回退后重新匹配同一个节点时不再查询图数据库，未命中的部分合并为一次批量查询。
+    返回的都是副本，调用方可以修改
+    """
+
+    def __init__(self, graph_manager):
+        self.graph_manager = graph_manager
+        self.scenes = {}
+        self.actions = {}
+        self.outgoing = {}
+        self.hits = 0
+        self.queries = 0
+
+    def get_outgoing_actions(self, scene_hash_id):
+        if scene_hash_id in self.outgoing:
+            self.hits += 1
+        else:
+            self.queries += 1
+            self.outgoing[scene_hash_id] = self.graph_manager.get_outgoing_actions(scene_hash_id)
+        return [dict(action) for action in self.outgoing[scene_hash_id]]
+
+    def _read_through(self, cache, hash_list, fetch):
+        missing = [hash_id for hash_id in dict.fromkeys(hash_list) if hash_id not in cache]
+        self.hits += len(hash_list) - len(missing)
+        if missing:
+            self.queries += 1
+            found = {info["hash_id"]: info for info in fetch(missing)}
+            for hash_id in missing:
+                # 不存在的节点也缓存，避免重复查询
+                cache[hash_id] = found.get(hash_id)
+        return [dict(cache[hash_id]) for hash_id in hash_list if cache[hash_id] is not None]
+
+    def get_info_from_scene_list(self, scene_list):
+        return self._read_through(self.scenes, scene_list, self.graph_manager.get_info_from_scene_list)
+
+    def get_info_from_action_list(self, action_list):
+        """
+        :return: 与GraphManager.get_info_from_action_list(action_list, with_arrival_scene=True)一致
+        """
+        def fetch(missing):
+            return self.graph_manager.get_info_from_action_list(missing, with_arrival_scene=True)
+        return self._read_through(self.actions, action_list, fetch)
+
+    def stats(self):
+        return {"hits": self.hits, "queries": self.queries}
+
+
+def create_graph_manager(name):
+    """
+    根据config.ini中[graph] backend选择图后端：neo4j 或 本地进程内的local
+    """
+    config = load_config()
+    backend = config.get('graph', 'backend', fallback='neo4j')
+    if backend == 'local':
+        from core.local_graph import LocalGraphManager
+        return LocalGraphManager(name)
+    elif backend == 'neo4j':
+        return GraphManager(name)
+    else:
+        raise ValueError(f"Invalid graph backend: {backend}. Must be 'neo4j' or 'local'.")
 
 
 if __name__ == '__main__':
-    pass
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the schema of a ProphetAgent graph database")
+    parser.add_argument("command", choices=["check-schema", "ensure-schema"])
+    parser.add_argument("graph_name", help="name of the neo4j database")
+    args = parser.parse_args()
+    graph_manager = create_graph_manager(args.graph_name)
+    if args.command == "ensure-schema":
+        graph_manager.ensure_schema()
+    report = graph_manager.check_schema()
+    if report["missing_constraints"] or report["missing_indexes"]:
+        print(f"missing constraints: {report['missing_constraints']}")
+        print(f"missing indexes: {report['missing_indexes']}")
+    else:
+        print("schema ok")
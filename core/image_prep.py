@@ -0,0 +1,79 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+class ImagePreparer:
+    """
+    发送给多模态模型前的图片预处理：按最长边缩放、重新编码为更紧凑的格式，
+    编码结果按源文件内容摘要缓存，重试和重复出现的控件截图不再重复读取和编码
+    """
+
+    def __init__(self, max_dim=1024, image_format="JPEG", quality=85, max_entries=256):
+        self.max_dim = max_dim
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.original_bytes = 0
+        self.uploaded_bytes = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, image_path):
+        """
+        :return: data url（带有正确的mime类型）、源文件字节数、编码后图片的字节数
+        """
+        with open(image_path, "rb") as f:
+            data = f.read()
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                url, encoded_size = self.entries[key]
+                self.original_bytes += len(data)
+                self.uploaded_bytes += encoded_size
+                return url, len(data), encoded_size
+        mime, encoded = self.encode(data)
+        url = f"data:{mime};base64,{base64.b64encode(encoded).decode('utf-8')}"
+        with self._lock:
+            self.misses += 1
+            self.original_bytes += len(data)
+            self.uploaded_bytes += len(encoded)
+            self.entries[key] = (url, len(encoded))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return url, len(data), len(encoded)
+
+    def encode(self, data):
+        image = Image.open(io.BytesIO(data))
+        original_mime = Image.MIME.get(image.format, "image/png")
+        image.load()
+        if self.max_dim > 0 and max(image.size) > self.max_dim:
+            image.thumbnail((self.max_dim, self.max_dim), Image.LANCZOS)
+        if self.image_format == "JPEG" and image.mode != "RGB":
+            # JPEG不支持透明通道，透明部分按白色背景合成
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.split()[-1])
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.image_format, quality=self.quality, optimize=True)
+        encoded = buffer.getvalue()
+        # 小图重新编码后可能反而变大，此时直接发送原图
+        if len(encoded) >= len(data):
+            return original_mime, data
+        return Image.MIME[self.image_format], encoded
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "original_bytes": self.original_bytes,
+                "uploaded_bytes": self.uploaded_bytes,
+            }
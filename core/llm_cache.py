@@ -0,0 +1,30 @@
+import hashlib
+import json
+from core.disk_cache import DiskCache
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class LLMResponseCache(DiskCache):
+    """
+    基于内容寻址的LLM回答磁盘缓存
+    key由模型、system prompt、user prompt、图片内容摘要和temperature共同决定，
+    输入不变时重跑semantic/execute阶段不再调用API
+    """
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        super().__init__(cache_dir, max_bytes)
+
+    @staticmethod
+    def make_key(model, system_prompt, user_prompt, images, temperature):
+        payload = json.dumps({
+            "model": model,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "images": [file_digest(img) for img in images],
+            "temperature": temperature,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -0,0 +1,202 @@
+import asyncio
+import configparser
+import threading
+import time
+import weakref
+import openai
+
+_config = None
+_config_lock = threading.Lock()
+_llm_client = None
+_llm_client_lock = threading.Lock()
+
+CHAT_API_VERSION = "2024-03-01-preview"
+
+
+def load_config(path='../config/config.ini'):
+    """
+    进程内只读取一次的配置，调用方不要修改返回的对象
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = configparser.ConfigParser()
+            _config.read(path)
+        return _config
+
+
+class LLMMetrics:
+    """
+    按调用类型(chat/embedding)统计调用次数、失败次数、耗时和服务端返回的token用量
+    """
+
+    def __init__(self):
+        self.kinds = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, latency, usage=None, error=False):
+        with self._lock:
+            metric = self.kinds.setdefault(kind, {"calls": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0,
+                                                  "prompt_tokens": 0, "completion_tokens": 0})
+            metric["calls"] += 1
+            metric["errors"] += int(error)
+            metric["total_latency"] += latency
+            metric["max_latency"] = max(metric["max_latency"], latency)
+            if usage is not None:
+                metric["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                metric["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def stats(self):
+        with self._lock:
+            return {kind: {**metric, "avg_latency": metric["total_latency"] / metric["calls"]}
+                    for kind, metric in self.kinds.items()}
+
+
+class LLMClientRegistry:
+    """
+    进程内共享的chat和embedding客户端：每类客户端只创建一次，复用同一个HTTP连接池的keep-alive连接。
+    同步调用共用一组客户端；异步客户端的连接池绑定事件循环，每个事件循环各自创建一组。
+    transport / async_transport 可以替换为任意httpx传输层（例如httpx.MockTransport），
+    测试和基准可以不访问网络
+    """
+
+    def __init__(self, config, transport=None, async_transport=None, max_retries=2, timeout=120.0):
+        self.config = config
+        self.transport = transport
+        self.async_transport = async_transport
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.metrics = LLMMetrics()
+        self._clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _create_client(self, kind, use_async):
+        if use_async:
+            http_client = openai.DefaultAsyncHttpxClient(transport=self.async_transport)
+        else:
+            http_client = openai.DefaultHttpxClient(transport=self.transport)
+        options = dict(max_retries=self.max_retries, timeout=self.timeout, http_client=http_client)
+        if kind == "chat":
+            client_class = openai.AsyncAzureOpenAI if use_async else openai.AzureOpenAI
+            return client_class(azure_endpoint=self.config.get('gpt4', 'endpoint'), api_version=CHAT_API_VERSION,
+                                api_key=self.config.get('gpt4', 'gpt_key'), **options)
+        client_class = openai.AsyncOpenAI if use_async else openai.OpenAI
+        return client_class(api_key=self.config.get('gpt4', 'embedding_key'),
+                            base_url=self.config.get('gpt4', 'embedding_url'), **options)
+
+    def client(self, kind):
+        with self._lock:
+            if kind not in self._clients:
+                self._clients[kind] = self._create_client(kind, False)
+            return self._clients[kind]
+
+    def async_client(self, kind):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            if kind not in clients:
+                clients[kind] = self._create_client(kind, True)
+            return clients[kind]
+
+    def chat(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            completion = self.client("chat").chat.completions.create(**kwargs)
+        except Exception:
+            self.metrics.record("chat", time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record("chat", time.perf_counter() - start, completion.usage)
+        return completion
+
+    async def achat(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            completion = await self.async_client("chat").chat.completions.create(**kwargs)
+        except Exception:
+            self.metrics.record("chat", time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record("chat", time.perf_counter() - start, completion.usage)
+        return completion
+
+    def embed(self, inputs, model=None):
+        """
+        :return: 与inputs顺序一致的向量列表
+        """
+        start = time.perf_counter()
+        try:
+            resp = self.client("embedding").embeddings.create(
+                model=model or self.config.get('gpt4', 'embedding_model'), input=inputs, encoding_format="float")
+        except Exception:
+            self.metrics.record("embedding", time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record("embedding", time.perf_counter() - start, resp.usage)
+        return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
+
+    async def aembed(self, inputs, model=None):
+        start = time.perf_counter()
+        try:
+            resp = await self.async_client("embedding").embeddings.create(
+                model=model or self.config.get('gpt4', 'embedding_model'), input=inputs, encoding_format="float")
+        except Exception:
+            self.metrics.record("embedding", time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record("embedding", time.perf_counter() - start, resp.usage)
+        return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
+
+    @staticmethod
+    async def _aclose_clients(clients):
+        for client in clients:
+            await client.close()
+
+    async def aclose(self):
+        """
+        关闭当前事件循环的异步客户端，异步调用方应在事件循环结束（例如asyncio.run返回）之前调用
+        """
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        await self._aclose_clients(clients.values())
+
+    def close(self):
+        """
+        关闭同步客户端和各事件循环的异步客户端；已关闭的事件循环上的连接无法再关闭，应改用aclose
+        """
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+            async_clients = list(self._async_clients.items())
+            self._async_clients.clear()
+        for loop, clients in async_clients:
+            if loop.is_closed():
+                continue
+            if loop.is_running():
+                # 事件循环正在其他线程运行（或是调用方自己的事件循环），交给该循环执行，不阻塞等待
+                asyncio.run_coroutine_threadsafe(self._aclose_clients(list(clients.values())), loop)
+            else:
+                loop.run_until_complete(self._aclose_clients(clients.values()))
+
+    def stats(self):
+        return self.metrics.stats()
+
+
+def get_llm_client(config=None):
+    """
+    进程内共享的LLM客户端注册表
+    """
+    global _llm_client
+    with _llm_client_lock:
+        if _llm_client is None:
+            # 重试和退避由core.rate_limit.LLMScheduler统一处理，SDK内部不再重试
+            _llm_client = LLMClientRegistry(config if config is not None else load_config(), max_retries=0)
+        return _llm_client
+
+
+def set_llm_client(registry):
+    """
+    替换进程内共享的客户端注册表（例如接入假服务端的传输层），返回原来的注册表
+    """
+    global _llm_client
+    with _llm_client_lock:
+        previous, _llm_client = _llm_client, registry
+        return previous
@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+from core.graph_manager import get_action_hash, scene_node_to_info
+from core.llm_client import load_config
+
+
+class LocalGraphStore:
+    """
+    进程内的Scene/Action图，节点属性保存在字典中，LEADS_TO关系保存为邻接表，持久化为一个JSON文件
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.scenes = {}
+        self.actions = {}
+        # scene -> actions, action -> scenes，以及用于删除的反向邻接表
+        self.scene_out = {}
+        self.action_out = {}
+        self.scene_in = {}
+        self.action_in = {}
+        # 反序列化后的bounds，避免每次查询都json.loads
+        self.parsed_bounds = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.scenes = data['scenes']
+        self.actions = data['actions']
+        for scene_hash, action_hash in data['scene_to_action']:
+            self.add_edge(self.scene_out, self.action_in, scene_hash, action_hash)
+        for action_hash, scene_hash in data['action_to_scene']:
+            self.add_edge(self.action_out, self.scene_in, action_hash, scene_hash)
+
+    def save(self):
+        with self.lock:
+            data = {
+                "scenes": self.scenes,
+                "actions": self.actions,
+                "scene_to_action": [[s, a] for s, actions in self.scene_out.items() for a in actions],
+                "action_to_scene": [[a, s] for a, scenes in self.action_out.items() for s in scenes],
+            }
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def get_bounds(self, action_hash):
+        if action_hash not in self.parsed_bounds:
+            self.parsed_bounds[action_hash] = json.loads(self.actions[action_hash]['bounds'])
+        return self.parsed_bounds[action_hash]
+
+    @staticmethod
+    def add_edge(out_dict, in_dict, start, end):
+        # dict保持插入顺序，同时起到去重的作用
+        out_dict.setdefault(start, {})[end] = None
+        in_dict.setdefault(end, {})[start] = None
+
+    @staticmethod
+    def remove_edge(out_dict, in_dict, start, end):
+        out_dict.get(start, {}).pop(end, None)
+        in_dict.get(end, {}).pop(start, None)
+
+
+class LocalGraphManager:
+    """
+    与GraphManager接口一致的本地图后端，无需连接Neo4j，查询均为内存中的字典和邻接表操作
+    """
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, name):
+        config = load_config()
+        local_dir = config.get('graph', 'local_dir', fallback='../graphs')
+        self.batch_size = config.getint('neo4j', 'batch_size', fallback=1000)
+        path = os.path.abspath(os.path.join(local_dir, f"{name}.json"))
+        # 同一个图在进程内共享一份数据
+        with LocalGraphManager._stores_lock:
+            if path not in LocalGraphManager._stores:
+                LocalGraphManager._stores[path] = LocalGraphStore(path)
+            self.store = LocalGraphManager._stores[path]
+
+    def ensure_schema(self):
+        pass
+
+    def check_schema(self):
+        # 本地后端按hash_id直接索引，不需要额外的约束
+        return {
+            "missing_constraints": [],
+            "missing_indexes": [],
+        }
+
+    def update_node_properties(self, node_type, hash_id, properties):
+        """
+        根据hash_id更新节点属性
+        :param node_type: 节点类型，可以是'scene'或'action'
+        """
+        if node_type not in ["Scene", "Action"]:
+            raise ValueError("Invalid node_type. Must be 'scene' or 'action'.")
+        nodes = self.store.scenes if node_type == "Scene" else self.store.actions
+        with self.store.lock:
+            if hash_id in nodes:
+                nodes[hash_id].update(properties)
+                self.store.parsed_bounds.pop(hash_id, None)
+                self.store.save()
+                print(f"{node_type.capitalize()} node with hash_id {hash_id} has been updated.")
+            else:
+                print(f"No {node_type} node found with hash_id {hash_id}.")
+
+    def delete_relationship(self, start_hash_id, end_hash_id):
+        with self.store.lock:
+            self.store.remove_edge(self.store.action_out, self.store.scene_in, start_hash_id, end_hash_id)
+            self.store.save()
+
+    def delete_scene_and_relationships_by_hash_id(self, scene_hash_id):
+        """
+        根据指定的scene_hash_id删除scene节点及其所有关系
+        :param scene_hash_id: 场景的hash_id
+        """
+        store = self.store
+        with store.lock:
+            for action_hash in list(store.scene_out.get(scene_hash_id, {})):
+                store.remove_edge(store.scene_out, store.action_in, scene_hash_id, action_hash)
+            for action_hash in list(store.scene_in.get(scene_hash_id, {})):
+                store.remove_edge(store.action_out, store.scene_in, action_hash, scene_hash_id)
+            store.scenes.pop(scene_hash_id, None)
+            store.scene_out.pop(scene_hash_id, None)
+            store.scene_in.pop(scene_hash_id, None)
+            store.save()
+        print(f"Scene with hash_id {scene_hash_id} and all related relationships have been deleted.")
+
+    def get_scene_by_action_hash_id(self, action_hash_id):
+        with self.store.lock:
+            for scene_hash in self.store.action_out.get(action_hash_id, {}):
+                return scene_node_to_info(self.store.scenes[scene_hash])
+        return None
+
+    def get_outgoing_actions(self, scene_hash_id):
+        """
+        获取指定场景的出度动作
+        :param scene_hash_id: 场景的hash_id
+        :return: 出度动作列表
+        """
+        actions = []
+        with self.store.lock:
+            for action_hash in self.store.scene_out.get(scene_hash_id, {}):
+                action = self.store.actions[action_hash]
+                actions.append({
+                    "hash_id": action.get('hash_id'),
+                    "name": action.get("name"),
+                    "element_semantic": action.get("element_semantic"),
+                    "description": action.get("description"),
+                    "bounds": self.store.get_bounds(action_hash),
+                    "resource_id": action.get("resource_id"),
+                })
+        return actions
+
+    def get_info_from_scene_list(self, scene_list):
+        """
+        根据场景列表获取场景信息
+        :param scene_list: 场景列表
+        :return: 场景信息列表
+        """
+        scene_info_list = []
+        with self.store.lock:
+            for scene_hash in scene_list:
+                if scene_hash in self.store.scenes:
+                    scene = self.store.scenes[scene_hash]
+                    scene_info_list.append({
+                        "hash_id": scene_hash,
+                        "name": scene.get("name"),
+                        "description": scene.get("description")
+                    })
+        return scene_info_list
+
+    def get_info_from_action_list(self, action_list, with_arrival_scene=False):
+        """
+        根据动作列表获取动作信息
+        :param action_list: 动作列表
+        :param with_arrival_scene: 同时返回每个动作到达的场景，结果的arrival_scene字段与get_scene_by_action_hash_id一致
+        :return: 动作信息列表
+        """
+        action_info_list = []
+        with self.store.lock:
+            for action_hash in action_list:
+                if action_hash in self.store.actions:
+                    action = self.store.actions[action_hash]
+                    action_info = {
+                        "hash_id": action.get("hash_id"),
+                        "name": action.get("name"),
+                        "description": action.get("description"),
+                        "element_semantic": action.get("element_semantic"),
+                        "bounds": action.get("bounds"),
+                        "resource_id": action.get("resource_id")
+                    }
+                    if with_arrival_scene:
+                        action_info["arrival_scene"] = self.get_scene_by_action_hash_id(action_hash)
+                    action_info_list.append(action_info)
+        return action_info_list
+
+    def _merge_node_info(self, node_info):
+        store = self.store
+        start_hash = node_info['start_state']['hash_id']
+        stop_hash = node_info['stop_state']['hash_id']
+        action_hash = get_action_hash(node_info)
+        store.scenes.setdefault(start_hash, {}).update(node_info['start_state'])
+        store.scenes.setdefault(stop_hash, {}).update(node_info['stop_state'])
+        store.actions.setdefault(action_hash, {}).update({
+            "hash_id": action_hash,
+            "name": node_info['action_state']['name'],
+            "element_semantic": node_info['action_state']['element_semantic'],
+            "description": node_info['action_state']['description'],
+            "bounds": json.dumps(node_info['action_state']['bounds']),
+            "resource_id": node_info['action_state']['resource_id'],
+            "event_type": node_info['action_state']['event_type'],
+        })
+        store.parsed_bounds.pop(action_hash, None)
+        store.add_edge(store.scene_out, store.action_in, start_hash, action_hash)
+        store.add_edge(store.action_out, store.scene_in, action_hash, stop_hash)
+
+    def build_graph_node(self, node_info):
+        """
+        根据节点信息构建节点
+        """
+        with self.store.lock:
+            self._merge_node_info(node_info)
+            self.store.save()
+
+    def build_graph_nodes(self, node_info_list, batch_size=None):
+        """
+        批量构图，全部写入后只持久化一次
+        :return: 写入的记录数
+        """
+        with self.store.lock:
+            for node_info in node_info_list:
+                self._merge_node_info(node_info)
+            self.store.save()
+        return len(node_info_list)
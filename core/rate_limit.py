@@ -0,0 +1,202 @@
+import email.utils
+import heapq
+import itertools
+import random
+import threading
+import time
+
+# 数值越小优先级越高：执行阶段的调用直接影响用例生成的等待时间，优先于批量的语义标注
+PRIORITY_EXECUTE = 0
+PRIORITY_SEMANTIC = 1
+
+
+def retry_after_seconds(error):
+    """
+    从服务端错误响应的retry-after-ms / retry-after头中读取建议的等待秒数，没有时返回None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                # HTTP日期格式
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_throttle_error(error):
+    return getattr(error, "status_code", None) == 429 or 'qpm limit' in str(error) or 'rate limit' in str(error).lower()
+
+
+class TokenBucket:
+    """
+    容量为每分钟预算、按每秒 预算/60 匀速补充的令牌桶，scale用于按限流情况临时降低补充速度
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.last = time.monotonic()
+
+    def refill(self, now, scale):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate * scale)
+        self.last = now
+
+    def wait_time(self, amount, scale):
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / (self.rate * scale)
+
+
+class LLMScheduler:
+    """
+    进程内共享的LLM调用调度器：
+    1. 请求数(RPM)和token数(TPM)分别用令牌桶限制，rpm / tpm 为0时表示不限制
+    2. 等待预算的调用按优先级排队，同优先级先到先得
+    3. 服务端限流时按Retry-After或带抖动的指数退避暂停所有调用方，并临时降低令牌补充速度，
+       之后每次成功的调用逐步恢复
+    """
+
+    def __init__(self, rpm=0, tpm=0, base_delay=1.0, max_delay=60.0, max_attempts=6):
+        self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.scale = 1.0
+        self._paused_until = 0.0
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.metrics = {"requests": 0, "throttled": 0, "retries": 0, "failed": 0}
+        self.queue_waits = {}
+
+    def _refill(self, now):
+        for bucket in (self.request_bucket, self.token_bucket):
+            if bucket is not None:
+                bucket.refill(now, self.scale)
+
+    def _wait_time(self, now, tokens):
+        wait = self._paused_until - now
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1, self.scale))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens, self.scale))
+        return wait
+
+    def acquire(self, tokens=0, priority=PRIORITY_SEMANTIC):
+        """
+        阻塞直到轮到当前调用且预算允许发出一个消耗tokens的请求
+        :return: 排队等待的秒数
+        """
+        if self.token_bucket is not None:
+            # 单个请求超过整个TPM预算时只能独占一个完整的桶
+            tokens = min(tokens, self.token_bucket.capacity)
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._queue, ticket)
+            while True:
+                if self._queue[0] != ticket:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    break
+                self._cond.wait(wait)
+            heapq.heappop(self._queue)
+            if self.request_bucket is not None:
+                self.request_bucket.tokens -= 1
+            if self.token_bucket is not None:
+                self.token_bucket.tokens -= tokens
+            waited = time.monotonic() - start
+            self.metrics["requests"] += 1
+            queue_wait = self.queue_waits.setdefault(priority, {"count": 0, "total_wait": 0.0, "max_wait": 0.0})
+            queue_wait["count"] += 1
+            queue_wait["total_wait"] += waited
+            queue_wait["max_wait"] = max(queue_wait["max_wait"], waited)
+            self._cond.notify_all()
+        return waited
+
+    def settle(self, reserved, used):
+        """
+        请求完成后按服务端返回的实际token用量修正预估值，多退少补
+        """
+        if self.token_bucket is None or used is None:
+            return
+        with self._cond:
+            self.token_bucket.tokens = min(self.token_bucket.capacity,
+                                           self.token_bucket.tokens + min(reserved, self.token_bucket.capacity) - used)
+            self._cond.notify_all()
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        第attempt次重试前的等待秒数：服务端给出Retry-After时以其为准，否则为full jitter的指数退避
+        """
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def pause(self, seconds):
+        """
+        服务端返回限流错误时，暂停所有调用方seconds秒，而不是每个线程各自sleep
+        """
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def call(self, func, tokens=0, priority=PRIORITY_SEMANTIC):
+        """
+        在预算内执行func，失败时按退避策略重试，重试max_attempts次后抛出最后一次的异常
+        """
+        for attempt in range(self.max_attempts):
+            self.acquire(tokens, priority)
+            try:
+                result = func()
+            except Exception as e:
+                if attempt == self.max_attempts - 1:
+                    with self._cond:
+                        self.metrics["failed"] += 1
+                    raise
+                delay = self.backoff(attempt, retry_after_seconds(e))
+                print(f"llm call failed: {e}, retry in {delay:.1f}s")
+                with self._cond:
+                    self.metrics["retries"] += 1
+                    if is_throttle_error(e):
+                        self.metrics["throttled"] += 1
+                        # 同一次限流中并发失败的调用只降速一次，并清空已积累的突发额度
+                        if time.monotonic() >= self._paused_until:
+                            self.scale = max(0.1, self.scale / 2)
+                            for bucket in (self.request_bucket, self.token_bucket):
+                                if bucket is not None:
+                                    bucket.tokens = min(bucket.tokens, 0.0)
+                if is_throttle_error(e):
+                    self.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+            with self._cond:
+                self.scale = min(1.0, self.scale + 0.01)
+            return result
+
+    def stats(self):
+        with self._cond:
+            return {
+                **self.metrics,
+                "rate_scale": round(self.scale, 3),
+                "queue_wait": {("execute" if priority == PRIORITY_EXECUTE else "semantic"): dict(
+                    queue_wait, avg_wait=queue_wait["total_wait"] / queue_wait["count"])
+                    for priority, queue_wait in self.queue_waits.items()},
+            }
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# agent_semantic 下的模块以同目录的模块名互相导入，与在该目录下运行时一致
+for path in [ROOT, os.path.join(ROOT, "agent_semantic")]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from agent_execute.benchmark import clustered_embeddings, ann_recall
+from agent_execute.embedding_index import EmbeddingIndex, IVFIndex
+
+
+def measured_recall(vectors, index, rng, k=10, steps=100):
+    # 查询为某个节点加噪声，与基准中的用例步骤一致
+    exact = EmbeddingIndex(range(len(vectors)), vectors)
+    queries = vectors[rng.integers(0, len(vectors), steps)] + \
+        rng.standard_normal((steps, vectors.shape[1])).astype(np.float32)
+    truth = [{key for key, _ in exact.search(query, k)} for query in queries]
+    found = [{key for key, _ in index.search(query, k)} for query in queries]
+    return ann_recall(truth, found)
+
+
+@pytest.mark.parametrize("noise", [1.0, 8.0])
+def test_auto_probe_keeps_recall(noise, capsys):
+    rng = np.random.default_rng(0)
+    vectors = clustered_embeddings(20000, 64, rng, cluster_count=500, noise=noise)
+    index = IVFIndex(range(len(vectors)), vectors)
+    assert index.recall >= index.target_recall
+    assert measured_recall(vectors, index, rng) >= 0.9
+    if noise > 1:
+        # 簇结构很弱时需要探查大部分簇，提示近似检索没有加速
+        assert index.probe > len(index.centroids) // 2
+        assert "poorly clustered" in capsys.readouterr().out
+
+
+def test_fixed_probe_below_target_warns(capsys):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((20000, 64)).astype(np.float32)
+    index = IVFIndex(range(len(vectors)), vectors, n_probe=8)
+    assert index.probe == 8
+    assert index.recall < index.target_recall
+    assert "below" in capsys.readouterr().out
+
+
+def test_save_and_load_keep_probe(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = clustered_embeddings(5000, 32, rng, cluster_count=100)
+    index = IVFIndex([f"action-{i}" for i in range(len(vectors))], vectors)
+    path = str(tmp_path / "action_ivf.npz")
+    index.save(path)
+    loaded = IVFIndex.load(path)
+    assert (loaded.n_probe, loaded.probe, loaded.target_recall) == (index.n_probe, index.probe, index.target_recall)
+    assert loaded.recall == pytest.approx(index.recall)
+    query = vectors[0]
+    assert loaded.search(query, 10) == index.search(query, 10)
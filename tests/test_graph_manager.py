@@ -0,0 +1,158 @@
+import configparser
+import threading
+import time
+
+import pytest
+
+from core import graph_manager
+from core.graph_manager import GraphManager
+
+
+class FakeGraph:
+    """
+    只记录查询语句的py2neo Graph替身，fail_schema为True时创建约束的语句抛出异常
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.queries = []
+        self.fail_schema = False
+        self.schema_delay = 0.0
+
+    def run(self, query, **params):
+        self.queries.append(query)
+        if query.startswith("CREATE CONSTRAINT"):
+            time.sleep(self.schema_delay)
+            if self.fail_schema:
+                raise RuntimeError("neo4j unavailable")
+        return []
+
+
+@pytest.fixture
+def fake_neo4j(monkeypatch):
+    config = configparser.ConfigParser()
+    config.read_dict({'neo4j': {'uri': 'bolt://neo4j.test', 'user': 'neo4j', 'password': 'fake'}})
+    graphs = {}
+
+    def fake_graph(uri, user, password, name):
+        return graphs.setdefault(name, FakeGraph())
+
+    monkeypatch.setattr(graph_manager, "load_config", lambda: config)
+    monkeypatch.setattr(graph_manager, "Graph", fake_graph)
+    monkeypatch.setattr(GraphManager, "_graph_pool", {})
+    monkeypatch.setattr(GraphManager, "_adjacency_caches", {})
+    monkeypatch.setattr(GraphManager, "_schema_checked", set())
+    return config, graphs
+
+
+def constraint_queries(graph):
+    return [query for query in graph.queries if query.startswith("CREATE CONSTRAINT")]
+
+
+def test_schema_is_created_once_per_database(fake_neo4j):
+    _, graphs = fake_neo4j
+    GraphManager("app")
+    GraphManager("app")
+    GraphManager("other")
+    assert len(constraint_queries(graphs["app"])) == 2
+    assert len(constraint_queries(graphs["other"])) == 2
+
+
+def test_failed_schema_is_retried(fake_neo4j):
+    _, graphs = fake_neo4j
+    graphs["app"] = FakeGraph()
+    graphs["app"].fail_schema = True
+    GraphManager("app")
+    assert ("bolt://neo4j.test", "neo4j", "app") not in GraphManager._schema_checked
+    graphs["app"].fail_schema = False
+    graphs["app"].queries.clear()
+    GraphManager("app")
+    assert len(constraint_queries(graphs["app"])) == 2
+    assert ("bolt://neo4j.test", "neo4j", "app") in GraphManager._schema_checked
+
+
+def test_concurrent_instance_waits_for_schema(fake_neo4j):
+    _, graphs = fake_neo4j
+    graphs["app"] = FakeGraph()
+    graphs["app"].schema_delay = 0.2
+    finished = {}
+
+    def build(name):
+        GraphManager("app")
+        finished[name] = time.monotonic()
+
+    first = threading.Thread(target=build, args=("first",))
+    first.start()
+    time.sleep(0.05)
+    second = threading.Thread(target=build, args=("second",))
+    second.start()
+    first.join()
+    second.join()
+    # 第二个实例在约束建好之后才构造完成，且不再重复创建约束
+    assert finished["second"] >= finished["first"]
+    assert len(constraint_queries(graphs["app"])) == 2
+
+
+def outgoing_record(scene_hash, action_hash, name):
+    return {"scene_hash": scene_hash, "hash_id": action_hash, "name": name, "description": "",
+            "element_semantic": "", "bounds": "[[0, 0], [10, 10]]", "resource_id": "", "arrival_scene": None}
+
+
+class AdjacencyGraph(FakeGraph):
+    """
+    出边查询返回当前的动作名称，fetch_started / release 用于让查询停在返回结果之前
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.action_name = "old"
+        self.fetch_started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def run(self, query, **params):
+        self.queries.append(query)
+        if "hash_id: $hash_id" in query:
+            record = outgoing_record(params["hash_id"], "action-1", self.action_name)
+            self.fetch_started.set()
+            self.release.wait()
+            return [record]
+        return []
+
+
+@pytest.fixture
+def lazy_manager(fake_neo4j):
+    config, graphs = fake_neo4j
+    config['neo4j']['adjacency_cache'] = 'lazy'
+    config['neo4j']['ensure_schema'] = 'false'
+    graphs["app"] = AdjacencyGraph()
+    return GraphManager("app"), graphs["app"]
+
+
+def test_lazy_cache_serves_hits_and_invalidates_on_write(lazy_manager):
+    manager, graph = lazy_manager
+    assert manager.get_outgoing_actions("scene-1")[0]["name"] == "old"
+    assert manager.get_outgoing_actions("scene-1")[0]["bounds"] == [[0, 0], [10, 10]]
+    assert len(graph.queries) == 1
+    graph.action_name = "new"
+    manager.invalidate_cache()
+    assert manager.get_outgoing_actions("scene-1")[0]["name"] == "new"
+    assert len(graph.queries) == 2
+
+
+def test_invalidate_during_slow_fetch_is_not_overwritten(lazy_manager):
+    manager, graph = lazy_manager
+    graph.release.clear()
+    results = []
+    reader = threading.Thread(target=lambda: results.append(manager.get_outgoing_actions("scene-1")))
+    reader.start()
+    assert graph.fetch_started.wait(5)
+    # 查询还没返回时发生写操作，读到的旧结果不能再写入缓存
+    graph.action_name = "new"
+    manager.invalidate_cache()
+    graph.release.set()
+    reader.join()
+    assert results[0][0]["name"] == "old"
+    assert manager.adjacency_cache.stats()["scenes"] == 0
+    assert manager.get_outgoing_actions("scene-1")[0]["name"] == "new"
+    assert manager.get_outgoing_actions("scene-1")[0]["name"] == "new"
+    assert len(graph.queries) == 2
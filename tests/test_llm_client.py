@@ -0,0 +1,120 @@
+import asyncio
+import configparser
+import json
+import threading
+
+try:
+    import httpx
+except ImportError:
+    # 较新的openai SDK依赖httpx2，接口与httpx一致
+    import httpx2 as httpx
+
+from core import llm_client
+from core.llm_client import LLMClientRegistry, load_config
+
+
+def handler(request):
+    if request.url.path.endswith("/embeddings"):
+        inputs = json.loads(request.content)["input"]
+        return httpx.Response(200, json={
+            "object": "list", "model": "fake-embedding",
+            "data": [{"object": "embedding", "index": i, "embedding": [float(i), 1.0]} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}})
+    return httpx.Response(200, json={
+        "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4}})
+
+
+def make_registry():
+    config = configparser.ConfigParser()
+    config.read_dict({'gpt4': {'endpoint': "http://llm.test", 'gpt_key': 'fake', 'embedding_url': "http://llm.test/v1",
+                               'embedding_key': 'fake', 'embedding_model': 'fake-embedding'}})
+    return LLMClientRegistry(config, transport=httpx.MockTransport(handler),
+                             async_transport=httpx.MockTransport(handler), max_retries=0)
+
+
+CHAT_KWARGS = dict(model="gpt-4o", messages=[{"role": "user", "content": "hello"}])
+
+
+def test_sync_clients_are_shared_across_threads():
+    registry = make_registry()
+    clients = []
+
+    def worker():
+        assert registry.chat(**CHAT_KWARGS).choices[0].message.content == "ok"
+        assert registry.embed(["a", "b"]) == [[0.0, 1.0], [1.0, 1.0]]
+        clients.append((registry.client("chat"), registry.client("embedding")))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(clients) == 4
+    assert len({id(chat) for chat, _ in clients}) == 1
+    assert len({id(embedding) for _, embedding in clients}) == 1
+    assert registry.stats()["chat"]["calls"] == 4
+    assert registry.stats()["embedding"]["prompt_tokens"] == 8
+    registry.close()
+
+
+def test_async_clients_are_created_per_event_loop():
+    registry = make_registry()
+
+    async def calls():
+        await asyncio.gather(*[registry.achat(**CHAT_KWARGS) for _ in range(3)])
+        assert await registry.aembed(["a"]) == [[0.0, 1.0]]
+        first = registry.async_client("chat")
+        assert registry.async_client("chat") is first
+        await registry.aclose()
+        assert first.is_closed()
+        return first
+
+    first = asyncio.run(calls())
+    second = asyncio.run(calls())
+    assert first is not second
+    assert registry.stats()["chat"]["calls"] == 6
+
+
+def test_close_closes_sync_and_async_clients():
+    registry = make_registry()
+    registry.chat(**CHAT_KWARGS)
+    sync_client = registry.client("chat")
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(registry.aembed(["a"]))
+        async_client = next(iter(registry._async_clients[loop].values()))
+        registry.close()
+        assert sync_client.is_closed()
+        assert async_client.is_closed()
+        assert len(registry._async_clients) == 0
+    finally:
+        loop.close()
+    # 关闭后再次调用会重新创建客户端
+    registry.chat(**CHAT_KWARGS)
+    assert registry.client("chat") is not sync_client
+    registry.close()
+
+
+def test_load_config_reads_file_once(tmp_path, monkeypatch):
+    path = tmp_path / "config.ini"
+    path.write_text("[semantic]\nworkers = 3\n")
+    reads = []
+    original_read = configparser.ConfigParser.read
+
+    def counting_read(self, *args, **kwargs):
+        reads.append(args)
+        return original_read(self, *args, **kwargs)
+
+    monkeypatch.setattr(llm_client, "_config", None)
+    monkeypatch.setattr(configparser.ConfigParser, "read", counting_read)
+    configs = []
+    threads = [threading.Thread(target=lambda: configs.append(load_config(str(path)))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(reads) == 1
+    assert all(config is configs[0] for config in configs)
+    assert configs[0].getint('semantic', 'workers') == 3
@@ -0,0 +1,55 @@
+import configparser
+
+import numpy as np
+import pytest
+
+from agent_execute import execute_agent
+from agent_execute.benchmark import write_synthetic_events, reset_pre_data, pre_data_state, same_pre_data
+from agent_execute.embedding_index import EmbeddingIndex
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    config = configparser.ConfigParser()
+    config.read_dict({'execute': {'snapshot': 'true', 'ann': 'false'}})
+    monkeypatch.setattr(execute_agent, "load_config", lambda: config)
+    yield execute_agent.ExecuteAgent()
+    reset_pre_data()
+
+
+def parse_events(agent, path):
+    reset_pre_data()
+    agent.load_events(path)
+    agent.scene_index = EmbeddingIndex.from_dict(execute_agent.Scene_hash_dict)
+    agent.action_index = EmbeddingIndex.from_dict(execute_agent.Action_hash_dict)
+
+
+def test_snapshot_start_matches_parsing_events(agent, tmp_path):
+    rng = np.random.default_rng(0)
+    write_synthetic_events(str(tmp_path), 60, 16, rng)
+    query = rng.standard_normal(16)
+    parse_events(agent, str(tmp_path))
+    parsed = pre_data_state(agent, query, 10)
+    # 同一控件的两个事件各自的动作信息不同，其中一对的值不是Action_hash_dict中的最终值
+    pairs = execute_agent.ACTION_SCENE_PAIR
+    assert any(info is not execute_agent.Action_hash_dict[view_str] for (view_str, _), info in pairs.items())
+
+    for _ in range(2):
+        # 第一次编译快照，第二次内存映射加载
+        reset_pre_data()
+        agent.build_pre_data(str(tmp_path))
+        assert same_pre_data(pre_data_state(agent, query, 10), parsed)
+    for (view_str, _), info in execute_agent.ACTION_SCENE_PAIR.items():
+        if info['action_name'] == execute_agent.Action_hash_dict[view_str]['action_name']:
+            assert info is execute_agent.Action_hash_dict[view_str]
+
+
+def test_snapshot_is_rebuilt_when_events_change(agent, tmp_path):
+    rng = np.random.default_rng(0)
+    write_synthetic_events(str(tmp_path), 20, 8, rng)
+    agent.build_pre_data(str(tmp_path))
+    events = tmp_path / "events" / "event_0.json"
+    events.write_text(events.read_text().replace('"action 0"', '"renamed action"'))
+    reset_pre_data()
+    agent.build_pre_data(str(tmp_path))
+    assert execute_agent.ACTION_SCENE_PAIR["view-0", "state-1"]['action_name'] == "renamed action"